@@ -1,44 +1,62 @@
 # app.py
 # -*- coding: utf-8 -*-
 from flask import Flask, render_template, request, jsonify
-from services.opendata import load_all_opendata_spots
-from utils.happiness import compute_happiness
-from utils.mood_filter import filter_by_mood
-from routes.api import api_bp
+from utils.response_cache import PageCache, compressed_response
+from routes.api import api_bp, SHARD_STORE
+from utils.happiness import DEFAULT_MOOD, resolve_mood
 import folium # 引入 folium
 import pandas as pd
 import json
 
 app = Flask(__name__)
 
-print("🚀 啟動 Flask：正在載入資料中…")
-MASTER_DF = load_all_opendata_spots()
-print(f"✅ 載入完成，共 {len(MASTER_DF)} 筆資料\n")
+def _parse_json_list(raw):
+    if not raw:
+        return []
+    try:
+        values = json.loads(raw)
+    except json.JSONDecodeError:
+        return []
+    if not isinstance(values, list):
+        return []
+    return [v for v in values if isinstance(v, str)]
+
+# 景點資料在 routes.api 匯入時載入（SHARD_STORE），這裡與 API 共用同一份分片
+DATASET_VERSION = SHARD_STORE.version
+# 已渲染並預先壓縮的首頁／地圖 HTML，key = (頁面, 心情, 景點清單, 資料版本)
+PAGE_CACHE = PageCache()
+print(f"✅ 載入完成，共 {SHARD_STORE.rows} 筆資料\n")
 
 @app.route("/")
 def index():
-    mood = request.args.get("mood", "療癒放鬆")
+    mood = resolve_mood(request.args.get("mood", DEFAULT_MOOD))
     user_lat = request.args.get("lat", type=float)
     user_lon = request.args.get("lon", type=float)
     map_only = request.args.get("map_only", "false").lower() == "true"
-    requested_names_raw = request.args.get("names")
-    requested_names = []
-    if requested_names_raw:
-        try:
-            requested_names = json.loads(requested_names_raw)
-        except json.JSONDecodeError:
-            requested_names = []
-
-    df = compute_happiness(MASTER_DF, mood, user_lat=user_lat, user_lon=user_lon)
-    df = filter_by_mood(df, mood)
-
-    if requested_names:
-        df = df[df["name"].isin(requested_names)]
-        if not df.empty:
-            df["name"] = pd.Categorical(df["name"], categories=requested_names, ordered=True)
-            df = df.sort_values("name")
+    requested_ids = _parse_json_list(request.args.get("ids"))
+    requested_names = _parse_json_list(request.args.get("names"))
+
+    # 頁面內容只由心情與景點清單決定（使用者位置不影響輸出），可直接重用
+    cache_key = (
+        "map" if map_only else "page",
+        mood,
+        tuple(requested_ids) if requested_ids else ("names",) + tuple(requested_names),
+        DATASET_VERSION,
+    )
+    entry = PAGE_CACHE.get(cache_key)
+    if entry is None:
+        body = render_index(mood, requested_ids, requested_names, map_only, user_lat, user_lon)
+        entry = PAGE_CACHE.put(cache_key, body)
+    return compressed_response(PAGE_CACHE, entry, request)
+
+def render_index(mood, requested_ids, requested_names, map_only, user_lat=None, user_lon=None):
+    if requested_ids or requested_names:
+        # 以雜湊索引取出指定景點（只載入所在的分片），保持請求順序
+        if not requested_ids:
+            requested_ids = [SHARD_STORE.resolve_name(n) for n in requested_names]
+        df = SHARD_STORE.scored_spots(mood, [i for i in requested_ids if i])
     else:
-        df = df.sort_values("happiness", ascending=False).head(10)
+        df = SHARD_STORE.top(mood, 10)
 
     # 創建 Folium 地圖
     # 預設地圖中心點，可以根據實際數據調整
@@ -62,6 +80,11 @@ def index():
         """
         if 'dist_score' in row and row['dist_score'] > 0:
             popup_html += f"距離分: {row['dist_score']:.1f}<br>"
+        # 匯入時已附加的鄰近測站讀數（測站本身不重複顯示）
+        if row['category'] != 'air' and pd.notna(row.get('air_value')):
+            popup_html += f"附近空氣 PM2.5: {row['air_value']:.1f}（{row['air_station']}）<br>"
+        if row['category'] != 'noise' and pd.notna(row.get('noise_value')):
+            popup_html += f"附近噪音: {row['noise_value']:.1f}（{row['noise_station']}）<br>"
 
         folium.Marker(
             location=[row["lat"], row["lon"]],
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+本機端對端壓力測試：
+
+    python loadtest.py --duration 20 --concurrency 8 --out bench.json
+
+以 data/ 的範例資料與 cache/ 的快照取代 OpenData 連線，在子 process 中以
+gunicorn 啟動與部署相同的 worker（預設 1 個），由本程式送出混合流量後輸出
+各路由的吞吐量與 p50/p95/p99 延遲。輸出為排序過的 JSON，方便與前一次結果做 diff。
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import requests
+
+from start import find_free_port
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_DIR = os.path.join(BASE_DIR, "data")
+SNAPSHOT_FILE = os.path.join(BASE_DIR, "cache", "spots_cache.json")
+
+MOODS = ["療癒放鬆", "城市漫步", "活力充電", "文化探索"]
+
+# 預設流量比例：地圖與推薦 API 佔大宗
+DEFAULT_MIX = "index=1,map_only=3,mood=4,result=1,complete=1"
+
+SURVEY_ANSWERS = [
+    ["療癒放鬆", "quiet_pref_quiet", "activity_static", "stress_high"],
+    ["活力充電", "quiet_pref_noisy", "activity_active", "stress_low"],
+    ["文化探索", "quiet_pref_quiet", "activity_static", "stress_medium"],
+    ["獨自沉澱", "quiet_pref_quiet", "activity_static", "stress_low"],
+]
+
+
+# -----------------------------------------------------
+# 以本地 fixture 取代 OpenData 來源
+# -----------------------------------------------------
+def _load_fixture(category):
+    path = os.path.join(FIXTURE_DIR, f"{category}.json")
+    if not os.path.exists(path):
+        return pd.DataFrame()
+    return pd.read_json(path)[["name", "category", "lat", "lon", "value"]]
+
+
+def _load_snapshot(category):
+    snapshot = pd.read_json(SNAPSHOT_FILE)
+    return snapshot[snapshot["category"] == category].reset_index(drop=True)
+
+
+def stub_opendata(work_dir):
+    """把 services.opendata 的各個 fetch 函數換成讀本地檔案，快照、分片與歷史紀錄寫到 work_dir"""
+    import services.opendata as opendata
+
+    opendata.fetch_art_events = lambda: _load_fixture("art_events")
+    opendata.fetch_noise_monitoring = lambda: _load_fixture("noise")
+    opendata.fetch_sports_facilities = lambda: _load_fixture("sports")
+    opendata.fetch_air_quality = lambda: _load_fixture("air")
+    opendata.load_local_parks = lambda: _load_snapshot("parks")
+    opendata.fetch_youbike_stations = lambda: _load_snapshot("youbike")
+    opendata.CACHE_FILE = os.path.join(work_dir, "spots_cache.json")
+
+    import services.shards as shards
+    shards.SHARD_DIR = os.path.join(work_dir, "shards")
+    import services.history as history
+    history.HISTORY_DIR = os.path.join(work_dir, "history")
+
+
+def create_app():
+    """
+    gunicorn 入口（loadtest:create_app()）：套用 stub 後才載入 app。
+    work_dir 由環境變數 LOADTEST_WORK_DIR 傳入。
+    """
+    work_dir = os.environ["LOADTEST_WORK_DIR"]
+    stub_opendata(work_dir)
+    import routes.api as api
+    api.PROGRESS_FILE = os.path.join(work_dir, "user_progress.json")
+    from app import app
+    return app
+
+
+def start_server(work_dir, workers=1, timeout=120):
+    """以 gunicorn 子 process 啟動 app，等到可以回應後回傳 (process, base_url, spots)"""
+    port = find_free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    log_path = os.path.join(work_dir, "server.log")
+    env = dict(os.environ, LOADTEST_WORK_DIR=work_dir)
+    with open(log_path, "w", encoding="utf-8") as log:
+        process = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "--workers", str(workers), "--bind", f"127.0.0.1:{port}",
+             "--chdir", BASE_DIR, "loadtest:create_app()"],
+            stdout=log, stderr=subprocess.STDOUT, env=env,
+        )
+
+    deadline = time.perf_counter() + timeout
+    while True:
+        if process.poll() is not None or time.perf_counter() > deadline:
+            stop_server(process)
+            with open(log_path, "r", encoding="utf-8") as f:
+                print(f.read()[-2000:])
+            raise SystemExit("❌ 無法啟動 gunicorn，請確認已安裝 requirements.txt 中的套件。")
+        try:
+            requests.get(base_url + "/survey", timeout=5)
+            break
+        except requests.RequestException:
+            time.sleep(0.5)
+
+    # 伺服器載入資料時已把快照寫到 work_dir，spot_id 與伺服器端相同
+    spots = pd.read_json(os.path.join(work_dir, "spots_cache.json"))
+    return process, base_url, spots
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+# -----------------------------------------------------
+# 各路由的請求產生器
+# -----------------------------------------------------
+def build_requests(spots):
+    spot_rows = spots[["spot_id", "name", "lat", "lon"]].to_dict(orient="records")
+
+    def index(rng):
+        return "GET", "/", {"params": {"mood": rng.choice(MOODS)}}
+
+    def map_only(rng):
+        return "GET", "/", {"params": {"mood": rng.choice(MOODS), "map_only": "true"}}
+
+    def mood(rng):
+        return "GET", f"/api/mood/{rng.choice(MOODS)}", {}
+
+    def result(rng):
+        return "POST", "/result", {"json": {"answers": rng.choice(SURVEY_ANSWERS)}}
+
+    def complete(rng):
+        spot = rng.choice(spot_rows)
+        return "POST", "/api/complete", {"json": {
+            "spot_id": spot["spot_id"],
+            "name": spot["name"],
+            "lat": spot["lat"],
+            "lon": spot["lon"],
+            "target_lat": spot["lat"],
+            "target_lon": spot["lon"],
+        }}
+
+    return {
+        "index": index,
+        "map_only": map_only,
+        "mood": mood,
+        "result": result,
+        "complete": complete,
+    }
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        route, _, weight = part.partition("=")
+        weights[route.strip()] = float(weight or 1)
+    return weights
+
+
+def run_load(base_url, generators, weights, duration, total, concurrency, seed):
+    routes = [r for r in weights if weights[r] > 0]
+    unknown = set(routes) - set(generators)
+    if unknown:
+        raise SystemExit(f"未知的路由：{', '.join(sorted(unknown))}")
+    route_weights = [weights[r] for r in routes]
+
+    samples = {r: [] for r in routes}
+    errors = {r: 0 for r in routes}
+    lock = threading.Lock()
+    counter = {"sent": 0}
+    deadline = time.perf_counter() + duration
+
+    def worker(worker_id):
+        rng = random.Random(seed + worker_id)
+        session = requests.Session()
+        while True:
+            with lock:
+                if total is not None and counter["sent"] >= total:
+                    return
+                counter["sent"] += 1
+            if total is None and time.perf_counter() >= deadline:
+                return
+            route = rng.choices(routes, weights=route_weights)[0]
+            method, path, kwargs = generators[route](rng)
+            t0 = time.perf_counter()
+            try:
+                resp = session.request(method, base_url + path, timeout=60, **kwargs)
+                ok = resp.status_code < 500
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - t0
+            with lock:
+                samples[route].append(elapsed)
+                if not ok:
+                    errors[route] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    wall = time.perf_counter() - started
+    return samples, errors, wall
+
+
+def summarize(samples, errors, wall):
+    def stats(values, n_errors):
+        if not values:
+            return {"requests": 0, "errors": n_errors}
+        ms = np.asarray(values) * 1000
+        return {
+            "requests": len(values),
+            "errors": n_errors,
+            "rps": round(len(values) / wall, 2),
+            "mean_ms": round(float(ms.mean()), 2),
+            "p50_ms": round(float(np.percentile(ms, 50)), 2),
+            "p95_ms": round(float(np.percentile(ms, 95)), 2),
+            "p99_ms": round(float(np.percentile(ms, 99)), 2),
+            "max_ms": round(float(ms.max()), 2),
+        }
+
+    report = {route: stats(samples[route], errors[route]) for route in sorted(samples)}
+    all_values = [v for values in samples.values() for v in values]
+    report["_total"] = stats(all_values, sum(errors.values()))
+    return report
+
+
+def print_table(report):
+    header = f"{'route':<10}{'reqs':>8}{'err':>6}{'rps':>10}{'p50':>10}{'p95':>10}{'p99':>10}"
+    print(header)
+    print("-" * len(header))
+    for route, s in report.items():
+        if not s.get("requests"):
+            print(f"{route:<10}{0:>8}{s['errors']:>6}")
+            continue
+        print(f"{route:<10}{s['requests']:>8}{s['errors']:>6}{s['rps']:>10.1f}"
+              f"{s['p50_ms']:>10.1f}{s['p95_ms']:>10.1f}{s['p99_ms']:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="台北幸福地圖本機壓力測試")
+    parser.add_argument("--duration", type=float, default=10.0, help="測試秒數（未指定 --requests 時）")
+    parser.add_argument("--requests", type=int, default=None, help="總請求數（指定後忽略 --duration）")
+    parser.add_argument("--concurrency", type=int, default=4, help="同時連線數")
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn worker 數")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="路由權重，例如 mood=4,map_only=3")
+    parser.add_argument("--warmup", type=int, default=10, help="正式測試前的暖身請求數")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="將 JSON 結果寫入檔案")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="loadtest-")
+    server = None
+    try:
+        server, base_url, spots = start_server(work_dir, args.workers)
+        generators = build_requests(spots)
+        weights = parse_mix(args.mix)
+
+        if args.warmup:
+            run_load(base_url, generators, weights, 0, args.warmup, 1, args.seed)
+
+        print(f"🚀 壓力測試：{base_url}，concurrency={args.concurrency}")
+        samples, errors, wall = run_load(
+            base_url, generators, weights, args.duration, args.requests, args.concurrency, args.seed
+        )
+        stop_server(server)
+        server = None
+
+        # 實際耗時每次都不同，只印出不寫進 JSON，避免干擾 diff
+        report = {
+            "config": {
+                "concurrency": args.concurrency,
+                "mix": weights,
+                "spots": len(spots),
+                "workers": args.workers,
+            },
+            "routes": summarize(samples, errors, wall),
+        }
+        print_table(report["routes"])
+        print(f"⏱️ 實際耗時 {wall:.1f} 秒")
+
+        output = json.dumps(report, ensure_ascii=False, indent=2, sort_keys=True)
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                f.write(output + "\n")
+            print(f"💾 結果已寫入 {args.out}")
+        else:
+            print(output)
+    finally:
+        if server is not None:
+            stop_server(server)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,17 @@
 # routes/api.py
 # -*- coding: utf-8 -*-
 from flask import Blueprint, jsonify, request # import request
-from services.opendata import load_all_opendata_spots # 引入新的載入函數
-from utils.happiness import compute_happiness, haversine_distance # 引入 haversine_distance
-from utils.mood_filter import filter_by_mood
+from services.opendata import load_spot_store # 引入新的載入函數
+from utils.happiness import DEFAULT_MOOD, haversine_distance, resolve_mood # 引入 haversine_distance
+from services.pipeline import TAIPEI_BBOX
+from services.history import LIVE_SOURCES, RESOLUTIONS, query_history
+from utils.clustering import build_cluster_levels, merge_cluster_levels, query_clusters
+from utils.itinerary import ITINERARY_CANDIDATES, MAX_STOPS, SEARCH_RADIUS_KM, plan_itinerary
+import numpy as np
 import pandas as pd
 import json
 from datetime import datetime
 import os
-# import numpy as np # Removed as haversine_distance is moved
 
 # 輔助函數：計算兩點距離 (Haversine 公式，回傳公里) - 已移動到 utils/happiness.py
 # def haversine_distance(lat1, lon1, lat2, lon2):
@@ -64,16 +67,38 @@ REQUIRED_BIKE_CHECKINS = 3 # 需要打卡 3 個不同的 YouBike 站點
 
 api_bp = Blueprint("api", __name__)
 
-MASTER = load_all_opendata_spots() # 使用新的載入函數
+# 用戶進度檔案位置（壓力測試等情境可改指向暫存檔）
+PROGRESS_FILE = os.path.join(os.path.dirname(__file__), "..", "user_progress.json")
 
-def get_recommendations(mood, user_lat=None, user_lon=None):
-    df = compute_happiness(MASTER, mood, user_lat=user_lat, user_lon=user_lon)
-    df = filter_by_mood(df, mood)
-    df = df.sort_values("happiness", ascending=False).head(10)
+# 依格網切分的景點分片；所有路由都經由它讀取資料，只載入需要的分片
+SHARD_STORE = load_spot_store() # 使用新的載入函數
+
+# 各心情的聚合層級快取（資料快照載入後不會變動，算一次即可；key 只會是已知心情）
+_CLUSTER_LEVELS = {}
+
+# 台北市中心預設經緯度（未提供起點時使用）
+DEFAULT_START = (25.0330, 121.5654)
+
+
+def _parse_bbox(raw):
+    """bbox 採 Leaflet toBBoxString() 格式：west,south,east,north；格式錯誤回傳 None"""
+    try:
+        bbox = tuple(float(v) for v in raw.split(","))
+    except ValueError:
+        return None
+    return bbox if len(bbox) == 4 else None
+
+def get_recommendations(mood, user_lat=None, user_lon=None, bbox=None):
+    if bbox is not None:
+        df = SHARD_STORE.filter_for_mood(SHARD_STORE.query(mood, bbox), mood)
+        df = df.sort_values("happiness", ascending=False).head(10)
+    else:
+        df = SHARD_STORE.top(mood, 10)
 
     rec = []
     for _, r in df.iterrows():
         item = {
+            "spot_id": r["spot_id"],
             "name": r["name"],
             "category": r["category"],
             "happiness": r["happiness"],
@@ -87,21 +112,153 @@ def get_recommendations(mood, user_lat=None, user_lon=None):
         }
         if 'dist_score' in r:
             item['dist_score'] = r['dist_score']
+        # 鄰近測站讀數（匯入時計算），沒有測站資料時不回傳
+        for source in ("air", "noise"):
+            if pd.notna(r.get(f"{source}_value")):
+                item[f"{source}_value"] = round(float(r[f"{source}_value"]), 1)
+                item[f"{source}_station"] = r[f"{source}_station"]
         rec.append(item)
     return rec
 
 @api_bp.route("/mood/<m>", methods=["GET"])
 def mood_api(m):
+    m = resolve_mood(m)
     user_lat = request.args.get("lat", type=float)
     user_lon = request.args.get("lon", type=float)
+    bbox = None
+    if request.args.get("bbox"):
+        bbox = _parse_bbox(request.args["bbox"])
+        if bbox is None:
+            return jsonify({"error": "bbox 格式錯誤，應為 west,south,east,north"}), 400
     return jsonify({
         "mood": m,
-        "recommendations": get_recommendations(m, user_lat, user_lon)
+        "recommendations": get_recommendations(m, user_lat, user_lon, bbox)
     })
 
+def get_cluster_levels(mood):
+    levels = _CLUSTER_LEVELS.get(mood)
+    if levels is None:
+        # 逐一對分片建立聚合再合併，不需要同時載入所有分片
+        levels = merge_cluster_levels([
+            build_cluster_levels(SHARD_STORE.filter_for_mood(SHARD_STORE.scored_shard(key, mood), mood))
+            for key in SHARD_STORE.shards
+        ])
+        _CLUSTER_LEVELS[mood] = levels
+    return levels
+
+@api_bp.route("/map/clusters", methods=["GET"])
+def map_clusters():
+    mood = resolve_mood(request.args.get("mood", DEFAULT_MOOD))
+    zoom = request.args.get("zoom", 13, type=int)
+    bbox = TAIPEI_BBOX
+    if request.args.get("bbox"):
+        bbox = _parse_bbox(request.args["bbox"])
+        if bbox is None:
+            return jsonify({"error": "bbox 格式錯誤，應為 west,south,east,north"}), 400
+
+    return jsonify(query_clusters(get_cluster_levels(mood), zoom, bbox))
+
+def _bbox_around(lat, lon, radius_km):
+    dlat = radius_km / 111.32
+    dlon = radius_km / (111.32 * np.cos(np.radians(lat)))
+    return (lon - dlon, lat - dlat, lon + dlon, lat + dlat)
+
+def get_itinerary_pool(mood, start_lat, start_lon, mode):
+    """
+    起點附近已計分的候選景點，只載入附近的分片。
+    範圍從搜尋半徑開始，半徑內不足 ITINERARY_CANDIDATES 個時逐次加倍，
+    因此 select_candidates 挑出的候選與對全部資料挑選相同。回傳 (候選景點, 實際使用的半徑)。
+    """
+    radius = SEARCH_RADIUS_KM.get(mode, SEARCH_RADIUS_KM["walk"])
+    while True:
+        bbox = _bbox_around(start_lat, start_lon, radius)
+        pool = SHARD_STORE.filter_for_mood(SHARD_STORE.query(mood, bbox), mood)
+        within = haversine_distance(start_lat, start_lon, pool["lat"].to_numpy(), pool["lon"].to_numpy()) <= radius
+        if within.sum() >= ITINERARY_CANDIDATES or SHARD_STORE.covers(bbox):
+            return pool.reset_index(drop=True), radius
+        radius *= 2
+
+@api_bp.route("/itinerary", methods=["GET"])
+def itinerary():
+    mood = resolve_mood(request.args.get("mood", DEFAULT_MOOD))
+    start_lat = request.args.get("lat", DEFAULT_START[0], type=float)
+    start_lon = request.args.get("lon", DEFAULT_START[1], type=float)
+    n_stops = request.args.get("stops", type=int)
+    budget_minutes = request.args.get("minutes", type=float)
+    mode = request.args.get("mode", "walk")
+    use_youbike = request.args.get("youbike", "false").lower() == "true"
+
+    if mode not in ("walk", "bike"):
+        return jsonify({"error": "mode 只能是 walk 或 bike"}), 400
+    if n_stops is not None:
+        n_stops = min(max(n_stops, 1), MAX_STOPS)
+    elif budget_minutes is not None:
+        n_stops = MAX_STOPS  # 只給時間預算時，停靠點數由預算決定
+
+    pool, radius = get_itinerary_pool(mood, start_lat, start_lon, mode)
+    stations = None
+    if mode == "bike" and use_youbike:
+        # 候選範圍外再多取 1 公里，邊緣停靠點的最近站點也在其中
+        nearby = SHARD_STORE.query(mood, _bbox_around(start_lat, start_lon, radius + 1))
+        stations = nearby[nearby["category"] == "youbike"]
+    plan = plan_itinerary(
+        pool, start_lat, start_lon,
+        n_stops=n_stops, budget_minutes=budget_minutes, mode=mode, stations=stations,
+    )
+    plan.update({"mood": mood, "mode": mode, "start": {"lat": start_lat, "lon": start_lon}})
+    return jsonify(plan)
+
+def _parse_time(raw, default):
+    """接受 epoch 秒數或 ISO 8601 字串"""
+    if raw is None:
+        return default
+    try:
+        return int(float(raw))
+    except ValueError:
+        return int(datetime.fromisoformat(raw).timestamp())
+
+@api_bp.route("/history/<spot>", methods=["GET"])
+def spot_history(spot):
+    current_spot = lookup_spot(spot, spot)
+    if current_spot is None:
+        return jsonify({"error": f"找不到景點 {spot}"}), 404
+    if current_spot["category"] not in LIVE_SOURCES:
+        return jsonify({"error": f"{current_spot['category']} 類別沒有歷史紀錄"}), 400
+
+    resolution = request.args.get("resolution", "hourly")
+    if resolution not in RESOLUTIONS:
+        return jsonify({"error": f"resolution 只能是 {', '.join(RESOLUTIONS)}"}), 400
+    now = int(datetime.now().timestamp())
+    try:
+        end = _parse_time(request.args.get("end"), now)
+        start = _parse_time(request.args.get("start"), end - 7 * 86400)
+    except ValueError:
+        return jsonify({"error": "start / end 需為 epoch 秒數或 ISO 8601 時間"}), 400
+
+    return jsonify({
+        "spot_id": current_spot["spot_id"],
+        "name": current_spot["name"],
+        "category": current_spot["category"],
+        "resolution": resolution,
+        "start": start,
+        "end": end,
+        "points": query_history(current_spot["category"], current_spot["spot_id"], start, end, resolution),
+    })
+
+def lookup_spot(spot_id=None, name=None, lat=None, lon=None):
+    """
+    以 spot_id（優先）或名稱查景點列，找不到回傳 None。
+    以名稱查詢時若有多個同名景點，取離 (lat, lon) 最近的一個；未提供座標才取第一個。
+    """
+    spot = SHARD_STORE.lookup(spot_id) if spot_id else None
+    if spot is None:
+        spot = SHARD_STORE.lookup(SHARD_STORE.resolve_name(name, lat, lon))
+    return spot
+
 @api_bp.route("/complete", methods=["POST"])
 def complete():
     data = request.get_json()
+    spot_id = data.get("spot_id")
     name = data.get("name")
     user_lat = data.get("lat")
     user_lon = data.get("lon")
@@ -113,8 +270,13 @@ def complete():
     if distance > 100:
         return jsonify({"message": f"❌ 你還距離目標 {round(distance)} 公尺，太遠啦！", "task_completed": False}), 400
 
+    current_spot = lookup_spot(spot_id, name, target_lat, target_lon)
+    if current_spot is not None:
+        spot_id = current_spot["spot_id"]
+        name = current_spot["name"]
+
     # 讀取用戶進度檔案
-    progress_file = os.path.join(os.path.dirname(__file__), "..", "user_progress.json")
+    progress_file = PROGRESS_FILE
     user_progress = {"checkins": [], "unique_checkin_names": [], "completed_tasks": [], "achievements": [], "survey_mood": "療癒放鬆"} # Initialize with all possible fields
     if os.path.exists(progress_file):
         try:
@@ -135,12 +297,15 @@ def complete():
     # 檢查是否已經打卡過
     existing_checkins = user_progress.get("checkins", [])
     for checkin in existing_checkins:
-        # 判斷標準：景點名稱、目標經緯度都相同
+        # 判斷標準：有 spot_id 時直接比對 ID，舊紀錄則比對景點名稱與目標經緯度
+        if spot_id and checkin.get("spot_id") == spot_id:
+            return jsonify({"message": f"你已經打卡過 {name} 了！", "task_completed": False}), 200
         if checkin["name"] == name and checkin["target_lat"] == target_lat and checkin["target_lon"] == target_lon:
             return jsonify({"message": f"你已經打卡過 {name} 了！", "task_completed": False}), 200
 
     # 添加新的打卡記錄
     new_checkin = {
+        "spot_id": spot_id,
         "name": name,
         "timestamp": datetime.now().isoformat(),
         "user_lat": user_lat,
@@ -158,9 +323,22 @@ def complete():
     task_completed = False
     achievement_unlocked = False
 
+    # 所有打卡過的景點各查一次索引，後續任務與成就判斷都從這份清單計算
+    current_category = current_spot["category"] if current_spot is not None else None
+    resolved_checkins = [
+        (c, lookup_spot(c.get("spot_id"), c["name"], c.get("target_lat"), c.get("target_lon")))
+        for c in user_progress["checkins"]
+    ]
+    checked_spots = [spot for _, spot in resolved_checkins if spot is not None]
+
     # Check for "Happiness Bell" task completion
+    # 以 spot_id 計算不同地點，同名的不同公園分開計算；查不到的舊紀錄才退回用名稱
+    unique_spots = {
+        spot["spot_id"] if spot is not None else f"name:{c['name']}"
+        for c, spot in resolved_checkins
+    }
     if HAPPINESS_BELL_TASK_ID not in [task["id"] for task in user_progress.get("completed_tasks", [])]:
-        if len(user_progress["unique_checkin_names"]) >= REQUIRED_UNIQUE_CHECKINS:
+        if len(unique_spots) >= REQUIRED_UNIQUE_CHECKINS:
             user_progress["completed_tasks"].append({
                 "id": HAPPINESS_BELL_TASK_ID,
                 "name": HAPPINESS_BELL_TASK_NAME,
@@ -168,142 +346,49 @@ def complete():
             })
             message += f" 恭喜您完成任務：{HAPPINESS_BELL_TASK_NAME}！"
             task_completed = True
-    
-    # Check for "Art Explorer" achievement
+
+    def unique_checkins(category, max_value=None):
+        return {
+            spot["spot_id"] for spot in checked_spots
+            if spot["category"] == category and (max_value is None or spot["value"] < max_value)
+        }
+
+    completed_ids = [ach["id"] for ach in user_progress.get("completed_tasks", [])]
+
     # Achievements are also stored in completed_tasks, but we might want a separate "achievements" list in user_progress
     # For now, let's keep them in completed_tasks for simplicity, but consider separating later.
-    if ACH_ART_EXPLORER_ID not in [ach["id"] for ach in user_progress.get("completed_tasks", [])]: 
-        # Get the category of the current checked-in spot
-        current_spot_category_df = MASTER[MASTER["name"] == name]["category"]
-        if not current_spot_category_df.empty:
-            current_spot_category = current_spot_category_df.iloc[0]
-
-        if current_spot_category == "art_events":
-            # Count unique art event check-ins
-            unique_art_checkins = set([
-                checkin["name"] for checkin in user_progress["checkins"]
-                    if not MASTER[MASTER["name"] == checkin["name"]]["category"].empty and \
-                       MASTER[MASTER["name"] == checkin["name"]]["category"].iloc[0] == "art_events"
-            ])
-            if len(unique_art_checkins) >= REQUIRED_ART_CHECKINS:
-                user_progress["completed_tasks"].append({
-                    "id": ACH_ART_EXPLORER_ID,
-                    "name": ACH_ART_EXPLORER_NAME,
-                    "description": "成功打卡 3 個不同的藝文景點",
-                    "timestamp": datetime.now().isoformat()
-                })
-                message += f" 恭喜您解鎖成就：{ACH_ART_EXPLORER_NAME}！"
-                achievement_unlocked = True
-    
-    # Check for "Park Wanderer" achievement
-    if ACH_PARK_WANDERER_ID not in [ach["id"] for ach in user_progress.get("completed_tasks", [])]:
-        current_spot_category_df = MASTER[MASTER["name"] == name]["category"]
-        if not current_spot_category_df.empty:
-            current_spot_category = current_spot_category_df.iloc[0]
-
-        if current_spot_category == "parks":
-            unique_park_checkins = set([
-                checkin["name"] for checkin in user_progress["checkins"]
-                    if not MASTER[MASTER["name"] == checkin["name"]]["category"].empty and \
-                       MASTER[MASTER["name"] == checkin["name"]]["category"].iloc[0] == "parks"
-            ])
-            if len(unique_park_checkins) >= REQUIRED_PARK_CHECKINS:
-                user_progress["completed_tasks"].append({
-                    "id": ACH_PARK_WANDERER_ID,
-                    "name": ACH_PARK_WANDERER_NAME,
-                    "description": "成功打卡 5 個不同的公園",
-                    "timestamp": datetime.now().isoformat()
-                })
-                message += f" 恭喜您解鎖成就：{ACH_PARK_WANDERER_NAME}！"
-                achievement_unlocked = True
-
-    # Check for "Sports Enthusiast" achievement
-    if ACH_SPORTS_ENTHUSIAST_ID not in [ach["id"] for ach in user_progress.get("completed_tasks", [])]:
-        current_spot_category_df = MASTER[MASTER["name"] == name]["category"]
-        if not current_spot_category_df.empty:
-            current_spot_category = current_spot_category_df.iloc[0]
-
-        if current_spot_category == "sports":
-            unique_sports_checkins = set([
-                checkin["name"] for checkin in user_progress["checkins"]
-                    if not MASTER[MASTER["name"] == checkin["name"]]["category"].empty and \
-                       MASTER[MASTER["name"] == checkin["name"]]["category"].iloc[0] == "sports"
-            ])
-            if len(unique_sports_checkins) >= REQUIRED_SPORTS_CHECKINS:
-                user_progress["completed_tasks"].append({
-                    "id": ACH_SPORTS_ENTHUSIAST_ID,
-                    "name": ACH_SPORTS_ENTHUSIAST_NAME,
-                    "description": "成功打卡 3 個不同的運動設施",
-                    "timestamp": datetime.now().isoformat()
-                })
-                message += f" 恭喜您解鎖成就：{ACH_SPORTS_ENTHUSIAST_NAME}！"
-                achievement_unlocked = True
-
-    # Check for "Fresh Air Seeker" achievement
-    if ACH_FRESH_AIR_SEEKER_ID not in [ach["id"] for ach in user_progress.get("completed_tasks", [])]:
-        current_spot = MASTER[MASTER["name"] == name]
-        if not current_spot.empty and current_spot["category"].iloc[0] == "air":
-            current_pm25 = current_spot["value"].iloc[0]
-            if current_pm25 < FRESH_AIR_PM25_THRESHOLD:
-                unique_fresh_air_checkins = set([
-                    checkin["name"] for checkin in user_progress["checkins"]
-                    if not MASTER[MASTER["name"] == checkin["name"]]["category"].empty and \
-                       MASTER[MASTER["name"] == checkin["name"]]["category"].iloc[0] == "air" and
-                       MASTER[MASTER["name"] == checkin["name"]]["value"].iloc[0] < FRESH_AIR_PM25_THRESHOLD
-                ])
-                if len(unique_fresh_air_checkins) >= REQUIRED_FRESH_AIR_CHECKINS:
-                    user_progress["completed_tasks"].append({
-                        "id": ACH_FRESH_AIR_SEEKER_ID,
-                        "name": ACH_FRESH_AIR_SEEKER_NAME,
-                        "description": f"成功打卡 {REQUIRED_FRESH_AIR_CHECKINS} 個 PM2.5 值低於 {FRESH_AIR_PM25_THRESHOLD} 的空氣監測站",
-                        "timestamp": datetime.now().isoformat()
-                    })
-                    message += f" 恭喜您解鎖成就：{ACH_FRESH_AIR_SEEKER_NAME}！"
-                    achievement_unlocked = True
-
-    # Check for "Quiet Guardian" achievement
-    if ACH_QUIET_GUARDIAN_ID not in [ach["id"] for ach in user_progress.get("completed_tasks", [])]:
-        current_spot = MASTER[MASTER["name"] == name]
-        if not current_spot.empty and current_spot["category"].iloc[0] == "noise":
-            current_noise_value = current_spot["value"].iloc[0]
-            if current_noise_value < QUIET_NOISE_THRESHOLD:
-                unique_quiet_checkins = set([
-                    checkin["name"] for checkin in user_progress["checkins"]
-                    if not MASTER[MASTER["name"] == checkin["name"]]["category"].empty and \
-                       MASTER[MASTER["name"] == checkin["name"]]["category"].iloc[0] == "noise" and
-                       MASTER[MASTER["name"] == checkin["name"]]["value"].iloc[0] < QUIET_NOISE_THRESHOLD
-                ])
-                if len(unique_quiet_checkins) >= REQUIRED_QUIET_CHECKINS:
-                    user_progress["completed_tasks"].append({
-                        "id": ACH_QUIET_GUARDIAN_ID,
-                        "name": ACH_QUIET_GUARDIAN_NAME,
-                        "description": f"成功打卡 {REQUIRED_QUIET_CHECKINS} 個噪音值低於 {QUIET_NOISE_THRESHOLD} 的噪音監測點",
-                        "timestamp": datetime.now().isoformat()
-                    })
-                    message += f" 恭喜您解鎖成就：{ACH_QUIET_GUARDIAN_NAME}！"
-                    achievement_unlocked = True
-
-    # Check for "YouBike Master" achievement
-    if ACH_BIKE_MASTER_ID not in [ach["id"] for ach in user_progress.get("completed_tasks", [])]:
-        current_spot_category_df = MASTER[MASTER["name"] == name]["category"]
-        if not current_spot_category_df.empty:
-            current_spot_category = current_spot_category_df.iloc[0]
-
-            if current_spot_category == "youbike":
-                unique_bike_checkins = set([
-                    checkin["name"] for checkin in user_progress["checkins"]
-                    if not MASTER[MASTER["name"] == checkin["name"]]["category"].empty and \
-                       MASTER[MASTER["name"] == checkin["name"]]["category"].iloc[0] == "youbike"
-                ])
-                if len(unique_bike_checkins) >= REQUIRED_BIKE_CHECKINS:
-                    user_progress["completed_tasks"].append({
-                        "id": ACH_BIKE_MASTER_ID,
-                        "name": ACH_BIKE_MASTER_NAME,
-                        "description": f"成功打卡 {REQUIRED_BIKE_CHECKINS} 個不同的 YouBike 站點",
-                        "timestamp": datetime.now().isoformat()
-                    })
-                    message += f" 恭喜您解鎖成就：{ACH_BIKE_MASTER_NAME}！"
-                    achievement_unlocked = True
+    achievements = [
+        # (id, name, description, category, required, value threshold)
+        (ACH_ART_EXPLORER_ID, ACH_ART_EXPLORER_NAME, "成功打卡 3 個不同的藝文景點",
+         "art_events", REQUIRED_ART_CHECKINS, None),
+        (ACH_PARK_WANDERER_ID, ACH_PARK_WANDERER_NAME, "成功打卡 5 個不同的公園",
+         "parks", REQUIRED_PARK_CHECKINS, None),
+        (ACH_SPORTS_ENTHUSIAST_ID, ACH_SPORTS_ENTHUSIAST_NAME, "成功打卡 3 個不同的運動設施",
+         "sports", REQUIRED_SPORTS_CHECKINS, None),
+        (ACH_FRESH_AIR_SEEKER_ID, ACH_FRESH_AIR_SEEKER_NAME,
+         f"成功打卡 {REQUIRED_FRESH_AIR_CHECKINS} 個 PM2.5 值低於 {FRESH_AIR_PM25_THRESHOLD} 的空氣監測站",
+         "air", REQUIRED_FRESH_AIR_CHECKINS, FRESH_AIR_PM25_THRESHOLD),
+        (ACH_QUIET_GUARDIAN_ID, ACH_QUIET_GUARDIAN_NAME,
+         f"成功打卡 {REQUIRED_QUIET_CHECKINS} 個噪音值低於 {QUIET_NOISE_THRESHOLD} 的噪音監測點",
+         "noise", REQUIRED_QUIET_CHECKINS, QUIET_NOISE_THRESHOLD),
+        (ACH_BIKE_MASTER_ID, ACH_BIKE_MASTER_NAME,
+         f"成功打卡 {REQUIRED_BIKE_CHECKINS} 個不同的 YouBike 站點",
+         "youbike", REQUIRED_BIKE_CHECKINS, None),
+    ]
+    for ach_id, ach_name, description, category, required, max_value in achievements:
+        if ach_id in completed_ids or current_category != category:
+            continue
+        if max_value is not None and not current_spot["value"] < max_value:
+            continue
+        if len(unique_checkins(category, max_value)) >= required:
+            user_progress["completed_tasks"].append({
+                "id": ach_id,
+                "name": ach_name,
+                "description": description,
+                "timestamp": datetime.now().isoformat()
+            })
+            message += f" 恭喜您解鎖成就：{ach_name}！"
+            achievement_unlocked = True
 
     # 儲存更新後的用戶進度檔案
     with open(progress_file, "w", encoding="utf-8") as f:
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+即時來源（YouBike、空氣品質）的歷史紀錄。
+
+每筆紀錄為固定寬度的 (ts, spot_id, value)，依時間附加寫入分段檔：
+    history/<source>/<resolution>/<segment_start>.seg
+讀取時以 np.memmap 對應檔案，再用 searchsorted 找出時間範圍，
+只有實際用到的頁面會被讀進記憶體。
+"""
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+HISTORY_DIR = os.path.join(os.path.dirname(__file__), "..", "history")
+
+# 需要保留歷史的即時來源
+LIVE_SOURCES = ["youbike", "air"]
+
+# spot_id 為 12 碼十六進位字串（見 services/opendata.py 的 assign_spot_ids）
+RAW_DTYPE = np.dtype([("ts", "<i8"), ("spot_id", "S12"), ("value", "<f4")])
+ROLLUP_DTYPE = np.dtype([
+    ("ts", "<i8"), ("spot_id", "S12"),
+    ("mean", "<f4"), ("min", "<f4"), ("max", "<f4"), ("count", "<u4"),
+])
+
+HOUR = 3600
+DAY = 86400
+
+# resolution → (聚合間隔秒數, 單一分段檔涵蓋秒數, 保留秒數)
+RESOLUTIONS = {
+    "raw": (None, DAY, 7 * DAY),
+    "hourly": (HOUR, 30 * DAY, 90 * DAY),
+    "daily": (DAY, 365 * DAY, 2 * 365 * DAY),
+}
+
+# 每個聚合層級的來源層級
+ROLLUP_FROM = {
+    "hourly": "raw",
+    "daily": "hourly",
+}
+
+MAX_HISTORY_POINTS = 5000
+
+
+def _dtype(resolution):
+    return RAW_DTYPE if resolution == "raw" else ROLLUP_DTYPE
+
+
+def _segment_dir(source, resolution, base_dir=None):
+    return os.path.join(base_dir or HISTORY_DIR, source, resolution)
+
+
+def _segment_start(ts, resolution):
+    span = RESOLUTIONS[resolution][1]
+    return int(ts) // span * span
+
+
+def _list_segments(source, resolution, base_dir=None):
+    """回傳 [(segment_start, path)]，依時間排序"""
+    seg_dir = _segment_dir(source, resolution, base_dir)
+    if not os.path.isdir(seg_dir):
+        return []
+    segments = []
+    for filename in os.listdir(seg_dir):
+        if filename.endswith(".seg"):
+            segments.append((int(filename[:-4]), os.path.join(seg_dir, filename)))
+    return sorted(segments)
+
+
+def _open_segment(path, dtype):
+    """以唯讀 memmap 對應分段檔；寫到一半的尾端殘缺紀錄會被忽略"""
+    count = os.path.getsize(path) // dtype.itemsize
+    if count == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+
+
+def _append(records, source, resolution, base_dir=None):
+    """依分段附加寫入；同一分段內時間必須非遞減，較舊的紀錄會被略過"""
+    if len(records) == 0:
+        return 0
+    seg_dir = _segment_dir(source, resolution, base_dir)
+    os.makedirs(seg_dir, exist_ok=True)
+    records = np.sort(records, order="ts", kind="stable")
+    starts = records["ts"] // RESOLUTIONS[resolution][1] * RESOLUTIONS[resolution][1]
+
+    written = 0
+    for seg_start in np.unique(starts):
+        chunk = records[starts == seg_start]
+        path = os.path.join(seg_dir, f"{int(seg_start)}.seg")
+        if os.path.exists(path):
+            existing = _open_segment(path, records.dtype)
+            if len(existing):
+                last_ts = int(existing["ts"][-1])
+                stale = chunk["ts"] < last_ts
+                if stale.any():
+                    print(f"[WARN] {source}/{resolution} 有 {int(stale.sum())} 筆紀錄早於既有資料，已略過。")
+                    chunk = chunk[~stale]
+            del existing
+        with open(path, "ab") as f:
+            f.write(chunk.tobytes())
+        written += len(chunk)
+    return written
+
+
+def record_snapshot(df, ts=None, base_dir=None):
+    """把 df 中即時來源的目前數值附加到 raw 歷史，回傳寫入筆數"""
+    ts = int(ts if ts is not None else time.time())
+    written = 0
+    for source in LIVE_SOURCES:
+        rows = df[df["category"] == source]
+        if rows.empty:
+            continue
+        records = np.empty(len(rows), dtype=RAW_DTYPE)
+        records["ts"] = ts
+        records["spot_id"] = rows["spot_id"].astype(str).str.encode("ascii").to_numpy()
+        records["value"] = pd.to_numeric(rows["value"], errors="coerce").to_numpy(dtype=float)
+        written += _append(records, source, "raw", base_dir)
+    return written
+
+
+def read_range(source, start, end, spot_id=None, resolution="raw", base_dir=None):
+    """
+    讀取 [start, end] 時間範圍內的紀錄（structured ndarray）。
+    每個分段只以 searchsorted 定位範圍，不會把整個檔案載入記憶體。
+    """
+    dtype = _dtype(resolution)
+    span = RESOLUTIONS[resolution][1]
+    key = spot_id.encode("ascii") if spot_id else None
+
+    chunks = []
+    for seg_start, path in _list_segments(source, resolution, base_dir):
+        if seg_start + span <= start or seg_start > end:
+            continue
+        mm = _open_segment(path, dtype)
+        ts = mm["ts"]
+        lo = np.searchsorted(ts, start, side="left")
+        hi = np.searchsorted(ts, end, side="right")
+        window = mm[lo:hi]
+        if key is not None:
+            window = window[window["spot_id"] == key]
+        chunks.append(np.array(window))
+        del mm
+    if not chunks:
+        return np.empty(0, dtype=dtype)
+    return np.concatenate(chunks)
+
+
+def _aggregate(records, resolution):
+    """把下一層級的紀錄依 (spot_id, 時間桶) 聚合成 ROLLUP_DTYPE"""
+    bucket = RESOLUTIONS[resolution][0]
+    df = pd.DataFrame({
+        "ts": records["ts"] // bucket * bucket,
+        "spot_id": records["spot_id"],
+    })
+    if "value" in records.dtype.names:
+        df["mean"] = df["min"] = df["max"] = records["value"]
+        df["count"] = 1
+    else:
+        for col in ("mean", "min", "max", "count"):
+            df[col] = records[col]
+    df = df.dropna(subset=["mean"])
+    df["weighted"] = df["mean"] * df["count"]
+    grouped = df.groupby(["ts", "spot_id"], sort=True).agg(
+        weighted=("weighted", "sum"), min=("min", "min"), max=("max", "max"), count=("count", "sum"),
+    ).reset_index()
+
+    out = np.empty(len(grouped), dtype=ROLLUP_DTYPE)
+    out["ts"] = grouped["ts"].to_numpy()
+    out["spot_id"] = grouped["spot_id"].to_numpy()
+    out["mean"] = (grouped["weighted"] / grouped["count"]).to_numpy()
+    out["min"] = grouped["min"].to_numpy()
+    out["max"] = grouped["max"].to_numpy()
+    out["count"] = grouped["count"].to_numpy()
+    return out
+
+
+def _watermark_path(source, resolution, base_dir=None):
+    return os.path.join(_segment_dir(source, resolution, base_dir), "watermark")
+
+
+def rollup(source, resolution, now=None, base_dir=None):
+    """
+    把已結束的時間桶從下一層級降採樣寫入 resolution 層級。
+    以 watermark 檔記錄已處理到的時間，重複執行不會重複寫入。
+    """
+    now = int(now if now is not None else time.time())
+    bucket = RESOLUTIONS[resolution][0]
+    cutoff = now // bucket * bucket   # 只處理已完整結束的時間桶
+
+    watermark_file = _watermark_path(source, resolution, base_dir)
+    watermark = 0
+    if os.path.exists(watermark_file):
+        with open(watermark_file, "r", encoding="utf-8") as f:
+            watermark = int(f.read().strip() or 0)
+    if cutoff <= watermark:
+        return 0
+
+    records = read_range(source, watermark, cutoff - 1, resolution=ROLLUP_FROM[resolution], base_dir=base_dir)
+    written = _append(_aggregate(records, resolution), source, resolution, base_dir) if len(records) else 0
+
+    os.makedirs(os.path.dirname(watermark_file), exist_ok=True)
+    with open(watermark_file, "w", encoding="utf-8") as f:
+        f.write(str(cutoff))
+    return written
+
+
+def enforce_retention(source, now=None, base_dir=None):
+    """刪除整段都超過保留期限的分段檔，回傳刪除的檔案數"""
+    now = int(now if now is not None else time.time())
+    removed = 0
+    for resolution, (_, span, retention) in RESOLUTIONS.items():
+        for seg_start, path in _list_segments(source, resolution, base_dir):
+            if seg_start + span <= now - retention:
+                os.remove(path)
+                removed += 1
+    return removed
+
+
+def maintain(now=None, base_dir=None):
+    """對所有即時來源依序做 hourly → daily 降採樣與保留期限清理"""
+    for source in LIVE_SOURCES:
+        rollup(source, "hourly", now, base_dir)
+        rollup(source, "daily", now, base_dir)
+        enforce_retention(source, now, base_dir)
+
+
+def query_history(source, spot_id, start, end, resolution="hourly", base_dir=None, limit=MAX_HISTORY_POINTS):
+    """回傳單一景點在時間範圍內的歷史（list of dict），超過 limit 時只保留最新的點"""
+    records = read_range(source, start, end, spot_id=spot_id, resolution=resolution, base_dir=base_dir)
+    records = records[-limit:]
+    points = []
+    for r in records:
+        point = {"ts": int(r["ts"])}
+        if resolution == "raw":
+            point["value"] = float(r["value"])
+        else:
+            point.update({
+                "mean": round(float(r["mean"]), 2),
+                "min": float(r["min"]),
+                "max": float(r["max"]),
+                "count": int(r["count"]),
+            })
+        points.append(point)
+    return points
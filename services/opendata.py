@@ -1,16 +1,24 @@
 # services/opendata.py
 # -*- coding: utf-8 -*-
+import argparse
 import json
+import hashlib
 import pandas as pd
 import os
 import requests
 import io # 引入 io 模組
 import numpy as np # 引入 numpy 模組
+from services.pipeline import clean_spots, enrich_environment
+from services import history
+from services.shards import ShardStore, ensure_shards
 
 # 臺北市立美術館的固定經緯度
 TAIPEI_FINE_ARTS_MUSEUM_LAT = 25.0747
 TAIPEI_FINE_ARTS_MUSEUM_LON = 121.5209
 
+# 經緯度為隨機偏移產生、不代表實際位置的類別
+SYNTHETIC_COORD_CATEGORIES = ["art_events"]
+
 # OpenData API 連結
 OPENDATA_APIS = {
     "art_events": "https://data.taipei/api/frontstage/tpeod/dataset/resource.download?rid=1700a7e6-3d27-47f9-89d9-1811c9f7489c", # 更改回 CSV 連結
@@ -21,6 +29,12 @@ OPENDATA_APIS = {
     "youbike": "https://tcgbusfs.blob.core.windows.net/dotapp/youbike/v2/youbike_immediate.json", # 新增 YouBike API
 }
 
+# 資料快照位置（壓力測試等情境可改指向暫存檔）
+CACHE_FILE = os.path.join(os.path.dirname(__file__), "..", "cache", "spots_cache.json")
+
+# 最近一次載入時被修正或移除的資料紀錄（見 services/pipeline.py）
+INGEST_REPORT = pd.DataFrame()
+
 def fetch_data_from_url(url, category, lat_col=None, lon_col=None, value_col=None, name_col=None, default_value=1.0):
     print(f"📡 正在從 {url} 獲取 {category} 資料...")
     try:
@@ -110,6 +124,7 @@ def fetch_noise_monitoring():
         default_value=50.0 # 假設一個中等噪音值
     )
     # 噪音數值應該是越低越好，所以這裡的 value 需要在 happiness.py 中反向處理
+    # 所有測點都是同一個預設值，enrich_environment 不會把它當成實測讀數附加到其他景點
     return df
 
 def fetch_sports_facilities():
@@ -158,14 +173,47 @@ def fetch_youbike_stations():
         default_value=0 # 預設為 0
     )
 
+def assign_spot_ids(df):
+    """
+    依內容 (category, name, 經緯度取到小數 5 位) 產生穩定的 spot_id。
+    座標為隨機產生的類別（見 SYNTHETIC_COORD_CATEGORIES）只用 category 與 name，
+    否則每次重新抓取 ID 都會改變。
+    同名公園等重複內容再加上出現序號，確保每列 ID 唯一且重新載入後不變。
+    """
+    df = df.reset_index(drop=True)
+    coords = "|" + df["lat"].round(5).astype(str) + "|" + df["lon"].round(5).astype(str)
+    coords = coords.where(~df["category"].isin(SYNTHETIC_COORD_CATEGORIES), "")
+    keys = df["category"].astype(str) + "|" + df["name"].astype(str) + coords
+    occurrence = keys.groupby(keys).cumcount()
+    keys = keys.where(occurrence == 0, keys + "#" + occurrence.astype(str))
+    df["spot_id"] = [hashlib.sha1(k.encode("utf-8")).hexdigest()[:12] for k in keys]
+    return df
+
+def dataset_version(df):
+    """資料快照的內容版本（spot_id 與數值的雜湊），快照更新後自動改變"""
+    digest = hashlib.sha1()
+    digest.update("\n".join(df["spot_id"]).encode("utf-8"))
+    digest.update(df["value"].to_numpy().tobytes())
+    return digest.hexdigest()[:12]
+
+def prepare_spots(raw):
+    """清理原始資料、附加鄰近測站讀數並產生 spot_id，同時更新 INGEST_REPORT"""
+    global INGEST_REPORT
+    master, INGEST_REPORT = clean_spots(raw)
+    if not INGEST_REPORT.empty:
+        summary = INGEST_REPORT.groupby(["action", "reason"]).size()
+        for (action, reason), count in summary.items():
+            print(f"[WARN] 資料清理：{action} {reason} 共 {count} 筆")
+    return assign_spot_ids(enrich_environment(master))
+
 def load_all_opendata_spots():
-    cache_file = os.path.join(os.path.dirname(__file__), "..", "cache", "spots_cache.json")
+    cache_file = CACHE_FILE
     
     # 嘗試從快取載入
     if os.path.exists(cache_file):
         try:
             print(f"💾 正在從快取檔案 {cache_file} 載入資料...")
-            master_df = pd.read_json(cache_file)
+            master_df = prepare_spots(pd.read_json(cache_file))
             print(f"✅ 從快取載入完成，共 {len(master_df)} 筆資料。")
             return master_df
         except Exception as e:
@@ -186,9 +234,16 @@ def load_all_opendata_spots():
         print("[ERR] 沒有任何 OpenData 資料成功載入！")
         return pd.DataFrame()
 
-    master = pd.concat(dfs, ignore_index=True)
+    master = prepare_spots(pd.concat(dfs, ignore_index=True))
     print(f"✅ OpenData 資料載入完成，共 {len(master)} 筆。")
 
+    # 即時來源的數值寫入歷史紀錄，並把已結束的時段降採樣成 hourly／daily
+    try:
+        history.record_snapshot(master)
+        history.maintain()
+    except OSError as e:
+        print(f"[ERR] 無法寫入歷史紀錄：{e}")
+
     # 將資料存入快取
     try:
         master.to_json(cache_file, orient="records", force_ascii=False, indent=2)
@@ -197,3 +252,38 @@ def load_all_opendata_spots():
         print(f"[ERR] 無法將資料存入快取：{e}")
 
     return master
+
+def load_spot_store():
+    """
+    載入資料快照並切成分片（同一版本已切分過則沿用），回傳 ShardStore。
+    完整的 DataFrame 只在這裡暫時存在；worker 之後只保留 manifest 與 LRU 中的分片。
+    """
+    master = load_all_opendata_spots()
+    return ShardStore(ensure_shards(master, dataset_version(master)))
+
+def refresh_live_history():
+    """
+    只重新抓取即時來源（YouBike、空氣品質）並寫入歷史紀錄，再做降採樣與保留期限清理。
+    適合由排程定期呼叫（python -m services.opendata --refresh-history），不影響資料快照。
+    """
+    dfs = [fetch_youbike_stations(), fetch_air_quality()]
+    dfs = [df for df in dfs if not df.empty]
+    if not dfs:
+        print("[WARN] 即時來源沒有資料，略過歷史紀錄。")
+        return 0
+    live, _ = clean_spots(pd.concat(dfs, ignore_index=True))
+    written = history.record_snapshot(assign_spot_ids(live))
+    history.maintain()
+    print(f"💾 已寫入 {written} 筆即時歷史紀錄。")
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenData 資料維護")
+    parser.add_argument("--refresh-history", action="store_true",
+                        help="抓取即時來源寫入歷史紀錄，並做降採樣與保留期限清理")
+    args = parser.parse_args()
+    if args.refresh_history:
+        refresh_live_history()
+    else:
+        parser.print_help()
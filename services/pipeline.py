@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+from utils.happiness import haversine_distance
+
+# -----------------------------------------------------
+# 匯入後清理：座標範圍檢查 + 跨來源去重
+# -----------------------------------------------------
+# 台北市範圍 (west, south, east, north)
+TAIPEI_BBOX = (121.45, 24.96, 121.67, 25.21)
+
+# 同名景點在此距離內視為重複（公尺），可依類別覆寫
+DEDUP_RADIUS_M = {}
+DEFAULT_DEDUP_RADIUS_M = 50
+# 座標為合成值的類別只以名稱判斷重複：art_events 以美術館為中心隨機偏移
+# ±0.005 度，同一展覽兩次出現最遠可相距約 1.5 公里，距離沒有參考價值。
+NAME_ONLY_DEDUP_CATEGORIES = ["art_events"]
+CROSS_SOURCE_RADIUS_M = 50
+
+# 不同來源重複時保留的順序：有實測數值的來源優先
+SOURCE_PRIORITY = ["air", "noise", "sports", "art_events", "parks", "youbike"]
+
+REPORT_COLUMNS = ["name", "category", "lat", "lon", "action", "reason", "duplicate_of"]
+
+METERS_PER_DEG_LAT = 111320.0
+
+
+def _in_bbox(lat, lon, bbox=TAIPEI_BBOX):
+    west, south, east, north = bbox
+    return lat.between(south, north) & lon.between(west, east)
+
+
+def validate_coordinates(df, bbox=TAIPEI_BBOX):
+    """
+    檢查經緯度是否落在台北市範圍內。
+    經緯度對調（lat/lon 填反）且對調後在範圍內者直接修正，其餘超出範圍或缺值者移除。
+    回傳 (清理後 df, 紀錄 DataFrame)。
+    """
+    df = df.copy()
+    missing = df["lat"].isna() | df["lon"].isna()
+    inside = _in_bbox(df["lat"], df["lon"], bbox) & ~missing
+    swapped = ~inside & ~missing & _in_bbox(df["lon"], df["lat"], bbox)
+
+    df.loc[swapped, ["lat", "lon"]] = df.loc[swapped, ["lon", "lat"]].to_numpy()
+
+    repaired = df[swapped].assign(action="repaired", reason="swapped_coordinates")
+    dropped = pd.concat([
+        df[missing].assign(action="dropped", reason="missing_coordinates"),
+        df[~inside & ~missing & ~swapped].assign(action="dropped", reason="outside_bbox"),
+    ])
+    report = pd.concat([repaired, dropped]).assign(duplicate_of=None)
+    return df[inside | swapped], report.reindex(columns=REPORT_COLUMNS)
+
+
+def _name_key(names):
+    return names.astype(str).str.normalize("NFKC").str.replace(r"\s+", "", regex=True).str.lower()
+
+
+def find_duplicates(df):
+    """
+    以格網雜湊做空間 join，找出同名且距離夠近的景點配對（避免 O(n²) 兩兩比較）。
+    NAME_ONLY_DEDUP_CATEGORIES 的類別則不看距離，同類別同名即視為重複。
+    回傳 Series：被合併列的位置 → 保留列的位置。
+    """
+    if df.empty:
+        return pd.Series(dtype=np.int64)
+
+    radius = max([DEFAULT_DEDUP_RADIUS_M, CROSS_SOURCE_RADIUS_M] + list(DEDUP_RADIUS_M.values()))
+    cell_lat = radius / METERS_PER_DEG_LAT
+    cell_lon = radius / (METERS_PER_DEG_LAT * np.cos(np.radians(df["lat"].mean())))
+
+    keyed = pd.DataFrame({
+        "pos": np.arange(len(df)),
+        "key": _name_key(df["name"]).to_numpy(),
+        "gx": np.floor(df["lon"].to_numpy() / cell_lon).astype(np.int64),
+        "gy": np.floor(df["lat"].to_numpy() / cell_lat).astype(np.int64),
+    })
+
+    # 與周圍 3x3 格內的同名點 join，格子邊長 = 最大合併半徑，不會漏掉配對
+    pairs = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            shifted = keyed.assign(gx=keyed["gx"] + dx, gy=keyed["gy"] + dy)
+            merged = keyed.merge(shifted, on=["key", "gx", "gy"], suffixes=("_a", "_b"))
+            pairs.append(merged.loc[merged["pos_a"] < merged["pos_b"], ["pos_a", "pos_b"]])
+
+    # 只看名稱的類別：同類別同名者都併入第一次出現的那一列
+    name_only = keyed[df["category"].isin(NAME_ONLY_DEDUP_CATEGORIES).to_numpy()]
+    name_only = name_only.assign(category=df["category"].to_numpy()[name_only["pos"].to_numpy()])
+    first = name_only.groupby(["category", "key"])["pos"].transform("min")
+    pairs.append(pd.DataFrame({"pos_a": first, "pos_b": name_only["pos"]})[first < name_only["pos"]])
+
+    pairs = pd.concat(pairs, ignore_index=True).drop_duplicates()
+    if pairs.empty:
+        return pd.Series(dtype=np.int64)
+
+    a = pairs["pos_a"].to_numpy()
+    b = pairs["pos_b"].to_numpy()
+    lat = df["lat"].to_numpy()
+    lon = df["lon"].to_numpy()
+    category = df["category"].to_numpy()
+    dist_m = haversine_distance(lat[a], lon[a], lat[b], lon[b]) * 1000
+
+    same_source = category[a] == category[b]
+    limit = np.where(
+        same_source,
+        pd.Series(category[a]).map(DEDUP_RADIUS_M).fillna(DEFAULT_DEDUP_RADIUS_M).to_numpy(),
+        CROSS_SOURCE_RADIUS_M,
+    )
+    limit = np.where(same_source & np.isin(category[a], NAME_ONLY_DEDUP_CATEGORIES), np.inf, limit)
+    close = dist_m <= limit
+    a, b = a[close], b[close]
+
+    # 優先序較高（同序則較早出現）的一方保留
+    priority = pd.Series(category).map({c: i for i, c in enumerate(SOURCE_PRIORITY)}).fillna(len(SOURCE_PRIORITY)).to_numpy()
+    rank = priority * len(df) + np.arange(len(df))
+    a_wins = rank[a] < rank[b]
+    winner = np.where(a_wins, a, b)
+    loser = np.where(a_wins, b, a)
+
+    # 同一列可能與多個點重複，取排名最高的保留列
+    merged_into = pd.Series(winner, index=loser)
+    merged_into = merged_into.groupby(level=0).agg(lambda w: w.iloc[np.argmin(rank[w.to_numpy()])])
+
+    # 保留列本身也被合併時，沿鏈找到最終保留的那一列
+    for _ in range(len(merged_into)):
+        chained = merged_into.map(merged_into).dropna().astype(np.int64)
+        if chained.empty:
+            break
+        merged_into.loc[chained.index] = chained
+    return merged_into
+
+
+def dedupe_spots(df):
+    """合併同來源與跨來源的重複景點，回傳 (清理後 df, 紀錄 DataFrame)"""
+    df = df.reset_index(drop=True)
+    merged_into = find_duplicates(df)
+    if merged_into.empty:
+        return df, pd.DataFrame(columns=REPORT_COLUMNS)
+
+    losers = merged_into.index.to_numpy()
+    keepers = df.iloc[merged_into.to_numpy()]
+    report = df.iloc[losers].assign(
+        action="dropped",
+        reason=np.where(
+            keepers["category"].to_numpy() == df["category"].iloc[losers].to_numpy(),
+            "duplicate", "cross_source_duplicate",
+        ),
+        duplicate_of=(keepers["category"] + ":" + keepers["name"].astype(str)).to_numpy(),
+    )
+    return df.drop(index=losers).reset_index(drop=True), report.reindex(columns=REPORT_COLUMNS)
+
+
+# -----------------------------------------------------
+# 環境資料 enrichment：最近測站的空氣／噪音讀數
+# -----------------------------------------------------
+ENV_SOURCES = ["air", "noise"]
+ENV_NEIGHBOURS = 3          # 以最近 3 個測站做距離反比加權
+ENV_MAX_DISTANCE_KM = 5.0   # 超過此距離的測站不列入
+ENV_MIN_DISTANCE_KM = 0.05  # 避免距離為 0 時權重無限大
+
+
+def attach_nearest_readings(df, source, k=ENV_NEIGHBOURS, max_km=ENV_MAX_DISTANCE_KM):
+    """
+    對每個景點找出 source 類別中最近的測站，新增欄位：
+    {source}_station（最近測站名稱）、{source}_station_km（距離）、
+    {source}_value（k 個最近測站讀數的距離反比加權平均）。
+    測站數量很少，直接以 broadcasting 算出 n x m 距離矩陣。
+    所有測站讀數都相同時（例如噪音監測點目前只有 fetch 時給的預設值）視為沒有實測資料，不附加讀數。
+    """
+    df = df.copy()
+    stations = df[df["category"] == source]
+    if stations.empty or df.empty or stations["value"].nunique() <= 1:
+        df[f"{source}_station"] = None
+        df[f"{source}_station_km"] = np.nan
+        df[f"{source}_value"] = np.nan
+        return df
+
+    dist = haversine_distance(
+        df["lat"].to_numpy()[:, None], df["lon"].to_numpy()[:, None],
+        stations["lat"].to_numpy()[None, :], stations["lon"].to_numpy()[None, :],
+    )
+    readings = stations["value"].to_numpy(dtype=float)
+    rows = np.arange(len(df))
+
+    nearest = np.argmin(dist, axis=1)
+    nearest_km = dist[rows, nearest]
+
+    k = min(k, len(stations))
+    neighbours = np.argpartition(dist, k - 1, axis=1)[:, :k]
+    neighbour_km = dist[rows[:, None], neighbours]
+    weights = np.where(neighbour_km <= max_km, 1.0 / np.maximum(neighbour_km, ENV_MIN_DISTANCE_KM) ** 2, 0.0)
+    weight_sum = weights.sum(axis=1)
+    weighted = (weights * readings[neighbours]).sum(axis=1)
+
+    df[f"{source}_station"] = np.where(nearest_km <= max_km, stations["name"].to_numpy()[nearest], None)
+    df[f"{source}_station_km"] = np.where(nearest_km <= max_km, nearest_km.round(3), np.nan)
+    df[f"{source}_value"] = np.where(weight_sum > 0, weighted / np.where(weight_sum > 0, weight_sum, 1.0), np.nan)
+    return df
+
+
+def enrich_environment(df):
+    """為所有景點附加最近的空氣與噪音測站讀數，請求時不需再計算距離"""
+    for source in ENV_SOURCES:
+        df = attach_nearest_readings(df, source)
+    return df
+
+
+def clean_spots(df):
+    """匯入清理流程：座標檢查 → 去重。回傳 (清理後 df, 所有修正／移除紀錄)"""
+    if df.empty:
+        return df, pd.DataFrame(columns=REPORT_COLUMNS)
+    df, coord_report = validate_coordinates(df)
+    df, dedupe_report = dedupe_spots(df)
+    reports = [r for r in (coord_report, dedupe_report) if not r.empty]
+    report = pd.concat(reports, ignore_index=True) if reports else pd.DataFrame(columns=REPORT_COLUMNS)
+    return df, report
@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+"""
+依地理格網切分的景點分片，也是 worker 讀取景點資料的唯一來源。
+
+快照依 SHARD_TILE_DEG 度的格網切成多個分片檔，寫在 cache/shards/<版本>/ 下。
+manifest.json 記錄每個分片的範圍與各類別數值的分佈（value → 筆數）；合併這些
+分佈即可得到全域的 min / max / 中位數與主分排名，因此只載入部分分片計算出的
+幸福指數，與把所有分片依 manifest 順序串接後整體計算的結果完全相同。
+
+以 spot_id 或名稱查景點用的索引也依雜湊分桶寫成小檔案（index/），
+查詢時只載入需要的那一桶。worker 平時只保留 manifest 與 LRU 中的分片和索引桶。
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from utils.happiness import MOOD_WEIGHTS, compute_happiness, haversine_distance, resolve_mood
+from utils.mood_filter import MOOD_TO_CATEGORY
+
+SHARD_DIR = os.path.join(os.path.dirname(__file__), "..", "cache", "shards")
+MANIFEST_FILE = "manifest.json"
+INDEX_DIR = "index"
+SHARD_TILE_DEG = 0.05   # 約 5 公里見方；台北市約切成 20～30 片
+SHARD_LRU_SIZE = 16     # 每個 worker 最多同時保留的分片數
+INDEX_BUCKET_CHARS = 2  # 索引依雜湊前 2 碼分成 256 桶
+INDEX_LRU_SIZE = 64     # 每個 worker 最多同時保留的索引桶數
+SHARD_KEEP_VERSIONS = 2 # 保留目前與前一個版本，仍在讀舊版的 worker 不受影響
+SHARD_FORMAT = 4        # 分片檔或 manifest 的格式改變時遞增，舊分片會重新切分
+
+
+def tile_keys(lat, lon, tile_deg=SHARD_TILE_DEG):
+    """經緯度 → 格網分片 key（例如 "501_2430"）"""
+    ty = np.floor(np.asarray(lat, dtype=float) / tile_deg).astype(np.int64)
+    tx = np.floor(np.asarray(lon, dtype=float) / tile_deg).astype(np.int64)
+    return pd.Series(ty).astype(str) + "_" + pd.Series(tx).astype(str)
+
+
+def _tile_bbox(key, tile_deg):
+    ty, tx = (int(v) for v in key.split("_"))
+    return [tx * tile_deg, ty * tile_deg, (tx + 1) * tile_deg, (ty + 1) * tile_deg]
+
+
+def _category_stats(df):
+    """各類別的數值分佈，可跨分片合併；缺值（NaN）也算一種數值，筆數才會與資料列一致"""
+    stats = {}
+    for category, values in df.groupby("category")["value"]:
+        counts = values.value_counts(dropna=False).sort_index()
+        stats[category] = {
+            "min": float(values.min()),
+            "max": float(values.max()),
+            "count": int(len(values)),
+            "values": [[float(v), int(n)] for v, n in counts.items()],
+        }
+    return stats
+
+
+def _bucket(key):
+    return hashlib.sha1(str(key).encode("utf-8")).hexdigest()[:INDEX_BUCKET_CHARS]
+
+
+def _write_index(keyed, index_dir):
+    """
+    寫出分桶索引：
+    ids-<桶>.json   spot_id → [分片 key, 分片內列號]
+    names-<桶>.json 名稱 → [[spot_id, lat, lon], ...]（依分片順序）
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    ids, names = {}, {}
+    columns = [keyed[c].tolist() for c in ("spot_id", "name", "lat", "lon", "_shard", "_row")]
+    for spot_id, name, lat, lon, key, row in zip(*columns):
+        ids.setdefault(_bucket(spot_id), {})[spot_id] = [key, int(row)]
+        names.setdefault(_bucket(name), {}).setdefault(name, []).append([spot_id, float(lat), float(lon)])
+    for kind, buckets in (("ids", ids), ("names", names)):
+        for bucket, entries in buckets.items():
+            with open(os.path.join(index_dir, f"{kind}-{bucket}.json"), "w", encoding="utf-8") as f:
+                json.dump(entries, f, ensure_ascii=False)
+
+
+def version_dir(version, shard_dir=None):
+    """每個快照版本（與分片格式）各自一個目錄，寫入後不再變動"""
+    return os.path.join(shard_dir or SHARD_DIR, f"{version}-{SHARD_FORMAT}")
+
+
+def prune_versions(keep_dir, shard_dir=None, keep=SHARD_KEEP_VERSIONS):
+    """刪除舊的版本目錄：保留 keep_dir 與其餘最新寫入的 keep - 1 個，回傳刪除的目錄數"""
+    shard_dir = shard_dir or SHARD_DIR
+    others = [
+        os.path.join(shard_dir, name) for name in os.listdir(shard_dir)
+        if not name.startswith(".") and os.path.isdir(os.path.join(shard_dir, name))
+        and os.path.join(shard_dir, name) != keep_dir
+    ]
+    others.sort(key=os.path.getmtime, reverse=True)
+    for path in others[keep - 1:]:
+        shutil.rmtree(path, ignore_errors=True)
+    return len(others[keep - 1:])
+
+
+def write_shards(df, version, shard_dir=None, tile_deg=SHARD_TILE_DEG):
+    """
+    把快照切成分片檔並寫出索引與 manifest，回傳 manifest。
+    先寫進本 process 專用的暫存目錄，完成後整個目錄 rename 成版本目錄；
+    多個 worker 同時切分時只有一個 rename 會成功，其他人捨棄自己的暫存目錄，
+    不會刪到或覆寫別人正在讀的檔案。rename 成功後只保留最近的 SHARD_KEEP_VERSIONS 個版本。
+    """
+    shard_dir = shard_dir or SHARD_DIR
+    os.makedirs(shard_dir, exist_ok=True)
+    target = version_dir(version, shard_dir)
+    tmp_dir = tempfile.mkdtemp(prefix=f".{os.path.basename(target)}-{os.getpid()}-", dir=shard_dir)
+
+    keyed = df.reset_index(drop=True)
+    keyed = keyed.assign(_shard=tile_keys(keyed["lat"], keyed["lon"], tile_deg))
+    keyed = keyed.sort_values("_shard", kind="stable")
+    keyed["_row"] = keyed.groupby("_shard").cumcount()
+
+    manifest = {"version": version, "format": SHARD_FORMAT, "tile_deg": tile_deg, "shards": []}
+    for key, shard in keyed.groupby("_shard", sort=True):
+        rows = shard.drop(columns=["_shard", "_row"])
+        filename = f"{key}.json"
+        rows.to_json(os.path.join(tmp_dir, filename), orient="records", force_ascii=False)
+        manifest["shards"].append({
+            "key": key,
+            "file": filename,
+            "rows": int(len(rows)),
+            "bbox": _tile_bbox(key, tile_deg),
+            "stats": _category_stats(rows),
+        })
+    _write_index(keyed, os.path.join(tmp_dir, INDEX_DIR))
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+
+    try:
+        os.rename(tmp_dir, target)
+    except OSError:
+        # 其他 worker 已經寫好同一版本，內容相同，直接沿用
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not os.path.exists(os.path.join(target, MANIFEST_FILE)):
+            raise
+        return manifest
+    prune_versions(target, shard_dir)
+    print(f"💾 已將 {len(df)} 筆資料切成 {len(manifest['shards'])} 個分片。")
+    return manifest
+
+
+def ensure_shards(df, version, shard_dir=None):
+    """此版本的分片目錄不存在時切分，回傳分片目錄"""
+    target = version_dir(version, shard_dir)
+    if not os.path.exists(os.path.join(target, MANIFEST_FILE)):
+        write_shards(df, version, shard_dir)
+    return target
+
+
+def _median_from_counts(values, counts):
+    """由 (value, 筆數) 分佈求出與 pandas median 相同的中位數"""
+    order = np.argsort(values)
+    values, counts = values[order], counts[order]
+    cumulative = np.cumsum(counts)
+    total = cumulative[-1]
+    lower = values[np.searchsorted(cumulative, (total - 1) // 2, side="right")]
+    upper = values[np.searchsorted(cumulative, total // 2, side="right")]
+    return (lower + upper) / 2
+
+
+class ShardStore:
+    """
+    依需求載入分片，分片資料、各心情的計分結果與索引桶都以 LRU 保留。
+    景點的全域順序為 manifest 的分片順序、分片內依快照順序；同分時依此順序排名。
+    未知的心情一律以預設心情計分（resolve_mood），各心情的快取因此有上限。
+    """
+
+    def __init__(self, shard_dir=None, max_shards=SHARD_LRU_SIZE):
+        shard_dir = shard_dir or SHARD_DIR
+        with open(os.path.join(shard_dir, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        self.shard_dir = shard_dir
+        self.max_shards = max_shards
+        self.version = manifest["version"]
+        self.shards = OrderedDict((s["key"], s) for s in manifest["shards"])
+        self.order = {key: i for i, key in enumerate(self.shards)}
+        self.rows = sum(s["rows"] for s in self.shards.values())
+
+        # 所有分片的 (分片順序, category, value, 筆數)，用來算全域統計與排名
+        rows = []
+        for key, shard in self.shards.items():
+            for category, stats in shard["stats"].items():
+                for value, count in stats["values"]:
+                    rows.append((self.order[key], category, value, count))
+        self.histogram = pd.DataFrame(rows, columns=["shard_order", "category", "value", "count"])
+        self.category_stats = self._merge_category_stats()
+
+        self._frames = OrderedDict()
+        self._scored = OrderedDict()
+        self._buckets = OrderedDict()
+        self._rank_tables = {}
+        self._lock = threading.Lock()
+
+    def _merge_category_stats(self):
+        # 與 compute_happiness 的 groupby min / max / median 相同，統計時略過缺值
+        merged = self.histogram.dropna(subset=["value"])
+        merged = merged.groupby(["category", "value"], as_index=False)["count"].sum()
+        stats = {}
+        for category, group in merged.groupby("category"):
+            values = group["value"].to_numpy()
+            counts = group["count"].to_numpy()
+            stats[category] = {
+                "vmin": values.min(),
+                "vmax": values.max(),
+                "median": _median_from_counts(values, counts),
+            }
+        return pd.DataFrame.from_dict(stats, orient="index")
+
+    def _cached(self, cache, key, limit, load):
+        with self._lock:
+            value = cache.get(key)
+            if value is not None:
+                cache.move_to_end(key)
+                return value
+        value = load()
+        with self._lock:
+            cache[key] = value
+            while len(cache) > limit:
+                cache.popitem(last=False)
+        return value
+
+    def keys_for_bbox(self, bbox):
+        """與 bbox=(west, south, east, north) 相交的分片 key"""
+        west, south, east, north = bbox
+        return [
+            key for key, shard in self.shards.items()
+            if shard["bbox"][0] <= east and shard["bbox"][2] >= west
+            and shard["bbox"][1] <= north and shard["bbox"][3] >= south
+        ]
+
+    def covers(self, bbox):
+        """bbox 是否已涵蓋所有分片"""
+        return len(self.keys_for_bbox(bbox)) == len(self.shards)
+
+    def load_shard(self, key):
+        path = os.path.join(self.shard_dir, self.shards[key]["file"])
+        return self._cached(self._frames, key, self.max_shards,
+                            lambda: pd.read_json(path, orient="records", dtype={"spot_id": str, "name": str}))
+
+    def categories_for(self, mood):
+        """心情對應的類別；與 filter_by_mood 相同，全部資料中都沒有這些類別時回傳 None（不篩選）"""
+        categories = MOOD_TO_CATEGORY.get(resolve_mood(mood), [])
+        if not self.histogram["category"].isin(categories).any():
+            return None
+        return categories
+
+    def filter_for_mood(self, df, mood):
+        """依全域資料決定的心情類別篩選 df（分片內沒有這些類別時回傳空表，而不是退回全部）"""
+        categories = self.categories_for(mood)
+        return df if categories is None else df[df["category"].isin(categories)]
+
+    def _rank_table(self, mood):
+        """
+        此心情下每個 (分片, category, value) 的主分（與 compute_happiness 同一公式），
+        以及每個 (分片, 主分) 之前排了幾筆：分數較高的筆數 + 前面分片中同分的筆數。
+        """
+        mood = resolve_mood(mood)
+        table = self._rank_tables.get(mood)
+        if table is None:
+            scored = compute_happiness(self.histogram, mood, category_stats=self.category_stats)
+            entries = self.histogram.assign(score=scored["main_score"].to_numpy(dtype=float))
+            blocks = (
+                entries.groupby(["score", "shard_order"], as_index=False, dropna=False)["count"].sum()
+                .sort_values(["score", "shard_order"], ascending=[False, True])
+            )
+            blocks["start"] = blocks["count"].cumsum() - blocks["count"]
+            starts = {
+                order: dict(zip(group["score"], group["start"]))
+                for order, group in blocks.groupby("shard_order")
+            }
+            table = {
+                "min": entries["score"].min(),
+                "max": entries["score"].max(),
+                "entries": entries,
+                "starts": starts,
+            }
+            self._rank_tables[mood] = table
+        return table
+
+    def _ranker(self, key, mood):
+        table = self._rank_table(mood)
+        starts = table["starts"].get(self.order[key], {})
+
+        def rank(main_score):
+            # 全域排名（method="first"，缺值排最後）= 之前的筆數 + 本分片內同分的順序
+            local = main_score.groupby(main_score, dropna=False).cumcount()
+            ranks = main_score.map(starts) + local + 1
+            return table["min"], table["max"], ranks.astype(float)
+
+        return rank
+
+    def scored_shard(self, key, mood):
+        mood = resolve_mood(mood)
+
+        def score():
+            return compute_happiness(
+                self.load_shard(key), mood,
+                category_stats=self.category_stats, score_ranker=self._ranker(key, mood),
+            )
+
+        return self._cached(self._scored, (key, mood), self.max_shards * len(MOOD_WEIGHTS), score)
+
+    def query(self, mood, bbox):
+        """只載入並計分與 bbox 相交的分片，回傳 bbox 內的景點"""
+        frames = [self.scored_shard(key, mood) for key in self.keys_for_bbox(bbox)]
+        frames = [f for f in frames if not f.empty]
+        if not frames:
+            return compute_happiness(pd.DataFrame(), mood)
+        df = pd.concat(frames, ignore_index=True)
+        west, south, east, north = bbox
+        return df[df["lat"].between(south, north) & df["lon"].between(west, east)]
+
+    def top(self, mood, n):
+        """
+        心情類別中幸福指數前 n 名。先由排名表找出前 n 名所在的分片，
+        只載入這些分片，結果與對全部資料 filter_by_mood 後取前 n 名相同。
+        """
+        entries = self._rank_table(mood)["entries"]
+        categories = self.categories_for(mood)
+        if categories is not None:
+            entries = entries[entries["category"].isin(categories)]
+        entries = entries.sort_values(["score", "shard_order"], ascending=[False, True])
+        needed = set(entries.loc[entries["count"].cumsum() - entries["count"] < n, "shard_order"])
+        keys = [key for key in self.shards if self.order[key] in needed]
+
+        frames = [self.filter_for_mood(self.scored_shard(key, mood), mood) for key in keys]
+        frames = [f for f in frames if not f.empty]
+        if not frames:
+            return compute_happiness(pd.DataFrame(), mood)
+        df = pd.concat(frames, ignore_index=True)
+        return df.sort_values("happiness", ascending=False).head(n)
+
+    def _index_bucket(self, kind, key):
+        path = os.path.join(self.shard_dir, INDEX_DIR, f"{kind}-{_bucket(key)}.json")
+
+        def load():
+            if not os.path.exists(path):
+                return {}
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+
+        return self._cached(self._buckets, (kind, _bucket(key)), INDEX_LRU_SIZE, load)
+
+    def locate(self, spot_id):
+        """spot_id → (分片 key, 分片內列號)，找不到回傳 None"""
+        location = self._index_bucket("ids", spot_id).get(spot_id)
+        return tuple(location) if location else None
+
+    def lookup(self, spot_id):
+        """以 spot_id 取出景點列（未計分），找不到回傳 None"""
+        location = self.locate(spot_id) if spot_id else None
+        if location is None:
+            return None
+        key, row = location
+        return self.load_shard(key).iloc[row]
+
+    def resolve_name(self, name, lat=None, lon=None):
+        """
+        名稱 → spot_id，找不到回傳 None。
+        有多個同名景點時取離 (lat, lon) 最近的一個；未提供座標才取第一個。
+        """
+        candidates = self._index_bucket("names", name).get(name) if name else None
+        if not candidates:
+            return None
+        if len(candidates) > 1 and lat is not None and lon is not None:
+            coords = np.array([c[1:] for c in candidates], dtype=float)
+            dist = haversine_distance(lat, lon, coords[:, 0], coords[:, 1])
+            return candidates[int(dist.argmin())][0]
+        return candidates[0][0]
+
+    def scored_spots(self, mood, spot_ids):
+        """依 spot_ids 的順序取出此心情下計分過的景點，找不到的 ID 略過"""
+        rows = []
+        for spot_id in spot_ids:
+            location = self.locate(spot_id)
+            if location is not None:
+                key, row = location
+                rows.append(self.scored_shard(key, mood).iloc[row])
+        if not rows:
+            return compute_happiness(pd.DataFrame(), mood)
+        return pd.DataFrame(rows).reset_index(drop=True)
@@ -98,11 +98,11 @@ function updateMapMarkers(recs = []) {
     const currentMood = urlParams.get('mood') || '療癒放鬆';
     const latParam = userGeolocation.lat ? `&lat=${userGeolocation.lat}` : '';
     const lonParam = userGeolocation.lon ? `&lon=${userGeolocation.lon}` : '';
-    const namesParam = recs.length
-        ? `&names=${encodeURIComponent(JSON.stringify(recs.map(r => r.name)))}`
+    const idsParam = recs.length
+        ? `&ids=${encodeURIComponent(JSON.stringify(recs.map(r => r.spot_id)))}`
         : '';
 
-    fetch(`/?mood=${currentMood}${latParam}${lonParam}&map_only=true${namesParam}`)
+    fetch(`/?mood=${currentMood}${latParam}${lonParam}&map_only=true${idsParam}`)
         .then(response => response.text())
         .then(mapHtml => {
             const mapContainer = document.getElementById('map-area');
@@ -144,7 +144,7 @@ function renderRecommendationList(recs) {
                 titleText = '點擊打卡！';
             }
 
-            checkinButtonHtml = `<button class="${btnClass}" ${isDisabled} title="${titleText}" onclick="completeTask('${r.name}', ${r.lat}, ${r.lon}, ${userGeolocation.lat}, ${userGeolocation.lon})">${btnText}</button>`;
+            checkinButtonHtml = `<button class="${btnClass}" ${isDisabled} title="${titleText}" onclick="completeTask('${r.spot_id}', '${r.name}', ${r.lat}, ${r.lon}, ${userGeolocation.lat}, ${userGeolocation.lon})">${btnText}</button>`;
         } else {
             checkinButtonHtml = '<button class="btn-checkin-disabled" disabled title="請先開啟位置服務，才能打卡喔！">打卡</button>';
         }
@@ -191,12 +191,13 @@ function navigateToSpot(lat, lon) {
 /* ============================================================
    打卡（加入距離判定）
 ============================================================ */
-function completeTask(name, lat, lon, userLat, userLon) {
+function completeTask(spotId, name, lat, lon, userLat, userLon) {
     // 距離驗證已在後端處理，這裡只需要發送請求
         fetch("/api/complete", {
             method: "POST",
             headers: {"Content-Type": "application/json"},
             body: JSON.stringify({
+                spot_id: spotId,
                 name: name,
             lat: userLat, // 傳遞用戶實際位置
             lon: userLon, // 傳遞用戶實際位置
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+
+# -----------------------------------------------------
+# 伺服器端標記聚合（依縮放層級 + 類別預先分格）
+# -----------------------------------------------------
+CLUSTER_MIN_ZOOM = 10
+CLUSTER_MAX_ZOOM = 18
+CLUSTER_CELL_PX = 64      # 每個聚合格子在螢幕上約 64x64 像素
+MAX_CLUSTER_FEATURES = 300  # 單次回傳的 feature 上限，與資料量無關
+TILE_SIZE = 256
+
+
+def mercator_pixels(lat, lon, zoom=0):
+    """經緯度 → Web Mercator 像素座標（向量化，與 Leaflet 相同投影）"""
+    lat = np.clip(np.asarray(lat, dtype=float), -85.05112878, 85.05112878)
+    lon = np.asarray(lon, dtype=float)
+    scale = TILE_SIZE * (2 ** zoom)
+    lat_rad = np.radians(lat)
+    x = (lon + 180.0) / 360.0 * scale
+    y = (1.0 - np.log(np.tan(lat_rad) + 1.0 / np.cos(lat_rad)) / np.pi) / 2.0 * scale
+    return x, y
+
+
+def clamp_zoom(zoom):
+    return int(min(max(zoom, CLUSTER_MIN_ZOOM), CLUSTER_MAX_ZOOM))
+
+
+def build_cluster_levels(df, zooms=None, cell_px=CLUSTER_CELL_PX):
+    """
+    對已計算幸福指數的 df，為每個縮放層級預先建立格狀聚合。
+    回傳 {zoom: DataFrame}，每列為一個 (格子, 類別) 聚合：
+    count、最佳幸福指數與對應景點、聚合中心經緯度。
+    """
+    if zooms is None:
+        zooms = range(CLUSTER_MIN_ZOOM, CLUSTER_MAX_ZOOM + 1)
+
+    columns = ["cx", "cy", "category", "count", "happiness", "best_spot_id", "best_name", "lat", "lon"]
+    if df.empty:
+        return {z: pd.DataFrame(columns=columns) for z in zooms}
+
+    # 依幸福指數排序一次，之後 groupby().first() 即為各聚合的最佳景點
+    ranked = df.sort_values("happiness", ascending=False)
+    px0, py0 = mercator_pixels(ranked["lat"].to_numpy(), ranked["lon"].to_numpy())
+
+    levels = {}
+    for z in zooms:
+        factor = (2 ** z) / cell_px
+        keyed = pd.DataFrame({
+            "cx": np.floor(px0 * factor).astype(np.int64),
+            "cy": np.floor(py0 * factor).astype(np.int64),
+            "category": ranked["category"].to_numpy(),
+            "happiness": ranked["happiness"].to_numpy(),
+            "spot_id": ranked["spot_id"].to_numpy(),
+            "name": ranked["name"].to_numpy(),
+            "lat": ranked["lat"].to_numpy(),
+            "lon": ranked["lon"].to_numpy(),
+        })
+        grouped = keyed.groupby(["cx", "cy", "category"], sort=False)
+        level = grouped.agg(
+            count=("name", "size"),
+            happiness=("happiness", "first"),
+            best_spot_id=("spot_id", "first"),
+            best_name=("name", "first"),
+            lat=("lat", "mean"),
+            lon=("lon", "mean"),
+        ).reset_index()
+        levels[z] = level[columns]
+    return levels
+
+
+def merge_cluster_levels(parts):
+    """
+    合併分別對各分片建立的聚合層級，結果與對全部資料一次 build_cluster_levels 相同：
+    筆數相加、中心為以筆數加權的平均，最佳景點取幸福指數最高者。
+    """
+    if not parts:
+        return build_cluster_levels(pd.DataFrame())
+
+    levels = {}
+    for z in parts[0]:
+        frames = [p[z] for p in parts if not p[z].empty]
+        if not frames:
+            levels[z] = parts[0][z]
+            continue
+        level = pd.concat(frames, ignore_index=True)
+        level = level.assign(wlat=level["lat"] * level["count"], wlon=level["lon"] * level["count"])
+        ranked = level.sort_values("happiness", ascending=False, kind="stable")
+        merged = ranked.groupby(["cx", "cy", "category"], sort=False).agg(
+            count=("count", "sum"),
+            happiness=("happiness", "first"),
+            best_spot_id=("best_spot_id", "first"),
+            best_name=("best_name", "first"),
+            wlat=("wlat", "sum"),
+            wlon=("wlon", "sum"),
+        ).reset_index()
+        merged["lat"] = merged["wlat"] / merged["count"]
+        merged["lon"] = merged["wlon"] / merged["count"]
+        levels[z] = merged[parts[0][z].columns]
+    return levels
+
+
+def query_clusters(levels, zoom, bbox, max_features=MAX_CLUSTER_FEATURES, cell_px=CLUSTER_CELL_PX):
+    """
+    依縮放層級與可視範圍 bbox=(west, south, east, north) 取出聚合，
+    回傳 GeoJSON FeatureCollection（dict）。feature 數量上限為 max_features，
+    超出時保留幸福指數最高的聚合。
+    """
+    z = clamp_zoom(zoom)
+    level = levels.get(z)
+    if level is None or level.empty:
+        return {"type": "FeatureCollection", "zoom": z, "truncated": False, "features": []}
+
+    west, south, east, north = bbox
+    factor = (2 ** z) / cell_px
+    x_min, y_min = mercator_pixels(north, west)
+    x_max, y_max = mercator_pixels(south, east)
+    cx_min, cx_max = np.floor(x_min * factor), np.floor(x_max * factor)
+    cy_min, cy_max = np.floor(y_min * factor), np.floor(y_max * factor)
+
+    mask = level["cx"].between(cx_min, cx_max) & level["cy"].between(cy_min, cy_max)
+    visible = level[mask]
+    truncated = len(visible) > max_features
+    if truncated:
+        visible = visible.nlargest(max_features, "happiness")
+
+    features = []
+    for r in visible.itertuples(index=False):
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [float(r.lon), float(r.lat)]},
+            "properties": {
+                "category": r.category,
+                "count": int(r.count),
+                "happiness": int(r.happiness),
+                "best_spot_id": r.best_spot_id,
+                "best_name": r.best_name,
+            },
+        })
+    return {"type": "FeatureCollection", "zoom": z, "truncated": bool(truncated), "features": features}
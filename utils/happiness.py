@@ -36,6 +36,13 @@ MOOD_WEIGHTS = {
     }
 }
 
+DEFAULT_MOOD = "療癒放鬆"
+
+
+def resolve_mood(mood):
+    """未知的心情一律視為預設心情，以心情為 key 的快取因此最多只有 len(MOOD_WEIGHTS) 筆"""
+    return mood if mood in MOOD_WEIGHTS else DEFAULT_MOOD
+
 # 新增基礎類別貢獻度 (Base Category Contribution)
 # 依圖示規範重新定義權重：空氣與綠地 25%，噪音 20%，
 # 藝文與運動各 15%。其餘資料集目前不計入幸福指數。
@@ -64,7 +71,14 @@ def happiness_color(v):
 # -----------------------------------------------------
 # 主幸福公式（新版）
 # -----------------------------------------------------
-def compute_happiness(df, mood, user_lat=None, user_lon=None, survey_mood=None):
+def compute_happiness(df, mood, user_lat=None, user_lon=None, survey_mood=None,
+                      category_stats=None, score_ranker=None):
+    """
+    category_stats / score_ranker 供分片載入時使用（見 services/shards.py）：
+    category_stats 為以 category 為 index、含 vmin / vmax / median 欄位的全域統計；
+    score_ranker(main_score) 回傳 (全域最小分, 全域最大分, 全域排名)。
+    未提供時都以 df 本身計算。
+    """
     df = df.copy()
 
     # 如果 DataFrame 是空的，直接返回一個空的 DataFrame
@@ -96,8 +110,12 @@ def compute_happiness(df, mood, user_lat=None, user_lon=None, survey_mood=None):
     # 1) 依 category 各自做 Min-Max
     # -----------------------------------------------------
     # 使用 groupby().transform() 優化，避免迴圈和多次篩選
-    df['vmin'] = df.groupby('category')['value'].transform('min')
-    df['vmax'] = df.groupby('category')['value'].transform('max')
+    if category_stats is not None:
+        df['vmin'] = df['category'].map(category_stats['vmin'])
+        df['vmax'] = df['category'].map(category_stats['vmax'])
+    else:
+        df['vmin'] = df.groupby('category')['value'].transform('min')
+        df['vmax'] = df.groupby('category')['value'].transform('max')
     
     # 處理 vmax == vmin 的情況
     # 先計算正常情況下的 value_norm
@@ -111,7 +129,10 @@ def compute_happiness(df, mood, user_lat=None, user_lon=None, survey_mood=None):
     )
     
     # 設置 base 為 category 的 value 中位數
-    df['base'] = df.groupby('category')['value'].transform('median')
+    if category_stats is not None:
+        df['base'] = df['category'].map(category_stats['median'])
+    else:
+        df['base'] = df.groupby('category')['value'].transform('median')
 
     # 移除臨時欄位
     df = df.drop(columns=['vmin', 'vmax'])
@@ -136,8 +157,11 @@ def compute_happiness(df, mood, user_lat=None, user_lon=None, survey_mood=None):
     # -----------------------------------------------------
     # 4) 幸福主分 Normalize → 0～100 區間
     # -----------------------------------------------------
-    min_s = df["main_score"].min()
-    max_s = df["main_score"].max()
+    if score_ranker is not None:
+        min_s, max_s, ranks = score_ranker(df["main_score"])
+    else:
+        min_s = df["main_score"].min()
+        max_s = df["main_score"].max()
 
     if max_s == min_s:
         df["main_norm"] = 50 # 如果所有分數都一樣，給予 50 分 (平均值)
@@ -148,8 +172,9 @@ def compute_happiness(df, mood, user_lat=None, user_lon=None, survey_mood=None):
     # -----------------------------------------------------
     # 5) 最終幸福 = 主分 (不再包含距離分)，並確保每個景點分數唯一
     # -----------------------------------------------------
-    # 先以主分排名，確保排序穩定，再轉換為 100,99,98…
-    ranks = df["main_score"].rank(method="first", ascending=False)
+    # 先以主分排名，確保排序穩定，再轉換為 100,99,98…（讀數缺值的景點排在最後）
+    if score_ranker is None:
+        ranks = df["main_score"].rank(method="first", ascending=False, na_option="bottom")
     df["happiness"] = (101 - ranks).astype(int)
 
     # 顏色
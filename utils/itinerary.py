@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from utils.happiness import haversine_distance
+
+# -----------------------------------------------------
+# 多點行程規劃（最近鄰 + 2-opt）
+# -----------------------------------------------------
+ITINERARY_CANDIDATES = 30   # 從起點附近幸福指數前 30 名中挑選停靠點
+DEFAULT_STOPS = 3
+MAX_STOPS = 10
+DWELL_MINUTES = 20          # 每個停靠點預估停留時間
+DETOUR_FACTOR = 1.3         # 直線距離 → 實際街道距離的粗估倍率
+TRAVEL_SPEED_KMH = {
+    "walk": 4.5,
+    "bike": 15.0,
+}
+# 候選景點與起點的最大直線距離（公里），約為各交通方式 30 分鐘的路程
+SEARCH_RADIUS_KM = {
+    "walk": 2.0,
+    "bike": 6.0,
+}
+
+
+def pairwise_distance_matrix(lat, lon):
+    """一次以 broadcasting 算出所有點兩兩之間的距離矩陣（公里）"""
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    return haversine_distance(lat[:, None], lon[:, None], lat[None, :], lon[None, :])
+
+
+def select_candidates(scored, start_lat, start_lon, mode="walk", n=ITINERARY_CANDIDATES):
+    """
+    從已計分的景點中挑出起點附近的候選：搜尋半徑內取幸福指數前 n 名
+    （同分取較近者）；半徑內不足 n 個時改取離起點最近的 n 個。
+    回傳 (候選 DataFrame, 候選與起點的距離)。
+    """
+    if scored.empty:
+        return scored, np.empty(0)
+    start_dist = haversine_distance(start_lat, start_lon, scored["lat"].to_numpy(), scored["lon"].to_numpy())
+    radius = SEARCH_RADIUS_KM.get(mode, SEARCH_RADIUS_KM["walk"])
+    nearby = np.flatnonzero(start_dist <= radius)
+    if len(nearby) >= n:
+        happiness = scored["happiness"].to_numpy()[nearby]
+        picked = nearby[np.lexsort((start_dist[nearby], -happiness))[:n]]
+    else:
+        picked = np.argsort(start_dist, kind="stable")[:n]
+    return scored.iloc[picked], start_dist[picked]
+
+
+def _with_start(dist, start_dist):
+    """把起點加成第 0 個節點，回傳 (n+1)x(n+1) 距離矩陣"""
+    n = len(start_dist)
+    full = np.zeros((n + 1, n + 1))
+    full[0, 1:] = start_dist
+    full[1:, 0] = start_dist
+    full[1:, 1:] = dist
+    return full
+
+
+def nearest_neighbour_route(full, n_stops=None, budget_minutes=None, minutes_per_km=None, dwell=DWELL_MINUTES):
+    """
+    從起點（節點 0）出發，每次走到最近且未拜訪的候選點。
+    n_stops 與 budget_minutes 至少給一個；超過時間預算的點不會加入。
+    """
+    n = full.shape[0] - 1
+    limit = min(n_stops or n, n)
+    visited = np.zeros(n + 1, dtype=bool)
+    visited[0] = True
+    route = []
+    current = 0
+    elapsed = 0.0
+    while len(route) < limit:
+        dists = np.where(visited, np.inf, full[current])
+        nxt = int(np.argmin(dists))
+        if not np.isfinite(dists[nxt]):
+            break
+        if budget_minutes is not None:
+            cost = dists[nxt] * minutes_per_km + dwell
+            if elapsed + cost > budget_minutes:
+                break
+            elapsed += cost
+        visited[nxt] = True
+        route.append(nxt)
+        current = nxt
+    return route
+
+
+def two_opt(route, full):
+    """起點固定、終點開放的 2-opt：反轉區段直到路徑長度不再縮短"""
+    path = [0] + list(route)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, len(path) - 1):
+            for j in range(i + 1, len(path)):
+                before = full[path[i - 1], path[i]]
+                after = full[path[i - 1], path[j]]
+                if j + 1 < len(path):
+                    before += full[path[j], path[j + 1]]
+                    after += full[path[i], path[j + 1]]
+                if after + 1e-9 < before:
+                    path[i:j + 1] = path[i:j + 1][::-1]
+                    improved = True
+    return path[1:]
+
+
+def nearest_station(stations, lat, lon):
+    """回傳距離 (lat, lon) 最近的 YouBike 站點（dict），沒有站點資料時回傳 None"""
+    if stations is None or stations.empty:
+        return None
+    dists = haversine_distance(lat, lon, stations["lat"].to_numpy(), stations["lon"].to_numpy())
+    idx = int(np.argmin(dists))
+    row = stations.iloc[idx]
+    return {
+        "name": row["name"],
+        "lat": float(row["lat"]),
+        "lon": float(row["lon"]),
+        "available_bikes": float(row["value"]),
+        "distance_m": round(float(dists[idx]) * 1000),
+    }
+
+
+def plan_itinerary(scored, start_lat, start_lon, n_stops=None, budget_minutes=None,
+                   mode="walk", stations=None):
+    """
+    scored：已計算幸福指數的景點（可快取重用）
+    先挑出起點附近的候選，再以最近鄰 + 2-opt 排出順序。
+    回傳依序拜訪的停靠點清單與總距離、總時間。
+    """
+    speed = TRAVEL_SPEED_KMH.get(mode, TRAVEL_SPEED_KMH["walk"])
+    minutes_per_km = 60.0 / speed * DETOUR_FACTOR
+
+    candidates, start_dist = select_candidates(scored, start_lat, start_lon, mode)
+    if candidates.empty:
+        return {"stops": [], "total_km": 0.0, "total_minutes": 0}
+
+    # 候選最多 30 個，兩兩距離矩陣每次重算只需幾十微秒
+    dist = pairwise_distance_matrix(candidates["lat"].to_numpy(), candidates["lon"].to_numpy())
+    full = _with_start(dist, start_dist)
+    if n_stops is None and budget_minutes is None:
+        n_stops = DEFAULT_STOPS
+    route = nearest_neighbour_route(full, n_stops=n_stops, budget_minutes=budget_minutes,
+                                    minutes_per_km=minutes_per_km)
+    route = two_opt(route, full)
+
+    stops = []
+    prev = 0
+    prev_lat, prev_lon = start_lat, start_lon
+    elapsed = 0.0
+    total_km = 0.0
+    for order, node in enumerate(route, start=1):
+        r = candidates.iloc[node - 1]
+        leg_km = float(full[prev, node]) * DETOUR_FACTOR
+        leg_minutes = leg_km / DETOUR_FACTOR * minutes_per_km
+        elapsed += leg_minutes
+        total_km += leg_km
+        stop = {
+            "order": order,
+            "spot_id": r["spot_id"],
+            "name": r["name"],
+            "category": r["category"],
+            "happiness": int(r["happiness"]),
+            "lat": float(r["lat"]),
+            "lon": float(r["lon"]),
+            "leg_km": round(leg_km, 2),
+            "leg_minutes": round(leg_minutes),
+            "arrive_minute": round(elapsed),
+        }
+        if mode == "bike" and stations is not None:
+            # 每一段都從出發點附近借車、在目的地附近還車
+            stop["pickup_station"] = nearest_station(stations, prev_lat, prev_lon)
+            stop["return_station"] = nearest_station(stations, r["lat"], r["lon"])
+        stops.append(stop)
+        elapsed += DWELL_MINUTES
+        prev = node
+        prev_lat, prev_lon = r["lat"], r["lon"]
+
+    return {"stops": stops, "total_km": round(total_km, 2), "total_minutes": round(elapsed)}
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import Response
+
+try:
+    import brotli  # 選用套件；沒有安裝時只提供 gzip
+except ImportError:
+    brotli = None
+
+# -----------------------------------------------------
+# 預先壓縮的頁面快取
+# -----------------------------------------------------
+PAGE_CACHE_MAX_ENTRIES = 256
+# 中等壓縮率：首頁壓縮只需數毫秒，大小與最高壓縮率相差不到一成
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# 伺服器端偏好順序（同樣 q 值時）
+ENCODING_PREFERENCE = ["br", "gzip", "identity"]
+
+
+def supported_encodings():
+    return ["br", "gzip", "identity"] if brotli is not None else ["gzip", "identity"]
+
+
+def compress(body, encoding):
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return body
+
+
+def negotiate_encoding(accept_encoding, available):
+    """依 Accept-Encoding（含 q 值）挑出可用的編碼，都不接受時回傳 identity"""
+    qualities = {}
+    for part in (accept_encoding or "").split(","):
+        token, _, params = part.strip().partition(";")
+        token = token.strip().lower()
+        if not token:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        qualities[token] = q
+
+    def quality(encoding):
+        if encoding in qualities:
+            return qualities[encoding]
+        if "*" in qualities:
+            return qualities["*"]
+        return 1.0 if encoding == "identity" else 0.0
+
+    candidates = [e for e in ENCODING_PREFERENCE if e in available and quality(e) > 0]
+    if not candidates:
+        return "identity"
+    return max(candidates, key=lambda e: (quality(e), -ENCODING_PREFERENCE.index(e)))
+
+
+class PageCache:
+    """
+    以 key 存放頁面，超過上限時淘汰最久未使用者（LRU）。
+    各編碼版本在第一次被請求時才壓縮並存起來，快取未命中只需壓縮一種。
+    """
+
+    def __init__(self, max_entries=PAGE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, body):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        entry = {
+            "etag": hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:16],
+            "variants": {"identity": body},
+        }
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def variant(self, entry, encoding):
+        """取出 entry 的某個編碼版本，尚未壓縮過時壓縮一次後存起來"""
+        body = entry["variants"].get(encoding)
+        if body is None:
+            body = compress(entry["variants"]["identity"], encoding)
+            with self._lock:
+                entry["variants"][encoding] = body
+        return body
+
+
+def compressed_response(cache, entry, request, mimetype="text/html"):
+    """依請求的 Accept-Encoding 回傳快取中已壓縮好的 bytes"""
+    encoding = negotiate_encoding(request.headers.get("Accept-Encoding"), supported_encodings())
+    response = Response(cache.variant(entry, encoding), mimetype=mimetype)
+    if encoding != "identity":
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Vary"] = "Accept-Encoding"
+    response.set_etag(f"{entry['etag']}-{encoding}")
+    return response.make_conditional(request)